@@ -11,11 +11,23 @@ if sys.version_info.major == 2:
 else:
     from gi.repository import GLib as gobject
 import sys
+import bisect
 import json
+import heapq
+import math
+import random
+import signal
+import struct
 import time
 import configparser # for config/ini file
+from array import array
+from collections import deque
 import paho.mqtt.client as mqtt
 import requests # for http GET
+try:
+  import numpy # optional, vectorized limit allocation
+except ImportError:
+  numpy = None
 
 try:
   import thread   # for daemon = True  / Python 2.x
@@ -23,7 +35,8 @@ except:
   import _thread as thread   # for daemon = True  / Python 3.x
 import dbus
 
-from threading import Thread
+import threading
+from threading import Thread, Lock, Event
 
 # our own packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
@@ -52,38 +65,1643 @@ class SessionBus(dbus.bus.BusConnection):
         return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
 
 
-def dbusconnection():
-    return SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else SystemBus()
+class DbusConnections:
+  # Bus connections of the process. Settings and other clients share one
+  # connection. Every VeDbusService needs a connection of its own: all of them
+  # export objects at the same paths ('/', '/Ac/Power', ...) and dbus-python
+  # allows only one object per path on a connection.
+  def __init__(self):
+    self._shared = None
+    self.count = 0
+    self.setupTime = 0
+
+
+  def _connect(self):
+    start = time.monotonic()
+    bus = SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else SystemBus()
+    self.setupTime += time.monotonic() - start
+    self.count += 1
+    return bus
+
+
+  def shared(self):
+    if self._shared is None:
+      self._shared = self._connect()
+    return self._shared
+
+
+  def private(self):
+    return self._connect()
+
+
+dbusConnections = DbusConnections()
+
+
+def dbusconnection():
+    return dbusConnections.private()
+
+
+def new_service(base, type, physical, logical, id, instance):
+    if instance == 0:
+      self =  VeDbusService("{}.{}".format(base, type), dbusconnection())
+    else:
+      self =  VeDbusService("{}.{}.{}_id{:02d}".format(base, type, physical,  id), dbusconnection())
+    # physical is the physical connection
+    # logical is the logical connection to align with the numbering of the console display
+    # Create the management objects, as specified in the ccgx dbus-api document
+    self.add_path('/Mgmt/ProcessName', __file__)
+    self.add_path('/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
+    self.add_path('/Mgmt/Connection', logical)
+
+    # Create the mandatory objects, note these may need to be customised after object creation
+    self.add_path('/DeviceInstance', instance)
+    self.add_path('/ProductId', 0)
+    self.add_path('/ProductName', '')
+    self.add_path('/FirmwareVersion', 0)
+    self.add_path('/HardwareVersion', 0)
+    self.add_path('/Connected', 0)  # Mark devices as disconnected until they are confirmed
+    self.add_path('/Serial', 0)
+
+    return self
+
+
+def getConfig():
+  config = configparser.ConfigParser()
+  config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
+  return config;
+
+
+################################################################################
+#                                                                              #
+#   Dbus                                                                       #
+#                                                                              #
+################################################################################
+
+# Minimum change of a value before it is published again, by path suffix
+_DEADBANDS = {
+  '/V':           0.5,
+  '/Voltage':     0.05,
+  '/F':           0.02,
+  '/I':           0.02,
+  '/Current':     0.02,
+  '/Efficiency':  0.1,
+  '/Temperature': 0.5,
+}
+
+
+def deadband(path):
+  return _DEADBANDS.get(path[path.rfind('/'):], 0)
+
+
+class DbusPublisher:
+  def __init__(self, dbusservice):
+    self._dbusservice = dbusservice
+    self._published = {}
+    self._deadbands = {}
+    # velib_python supports batched ItemsChanged signals since Venus OS 3.00
+    self._batched = hasattr(dbusservice, '__enter__')
+    self.itemsPublished = 0
+    self.itemsSuppressed = 0
+    self.signalsSaved = 0
+
+
+  def publish(self, values):
+    # Publish the values that changed by more than their deadband in a single signal
+    changes = []
+    for path, value in values.items():
+      last = self._published.get(path)
+      if last == value and path in self._published:
+        # VeDbusItemExport would not signal it either
+        continue
+
+      band = self._deadbands.get(path)
+      if band is None:
+        band = self._deadbands[path] = deadband(path)
+      if band and last is not None and value is not None and value != 0 and abs(value - last) < band:
+        self.itemsSuppressed += 1
+        continue
+
+      changes.append((path, value))
+
+    if len(changes) == 0:
+      return 0
+
+    if self._batched:
+      # One ItemsChanged signal instead of one PropertiesChanged signal per value
+      with self._dbusservice as s:
+        for path, value in changes:
+          s[path] = value
+      self.signalsSaved += len(changes) - 1
+    else:
+      for path, value in changes:
+        self._dbusservice[path] = value
+
+    for path, value in changes:
+      self._published[path] = value
+
+    self.itemsPublished += len(changes)
+    return len(changes)
+
+
+################################################################################
+#                                                                              #
+#   Statistics                                                                 #
+#                                                                              #
+################################################################################
+
+class RingBuffer:
+  # Fixed size history of floats with a running sum
+  def __init__(self, size, initial=0):
+    self._size = int(size)
+    self._data = array('d', [initial]) * self._size
+    self._index = 0
+    self._sum = float(initial) * self._size
+
+
+  def append(self, value):
+    old = self._data[self._index]
+    self._data[self._index] = value
+    self._index += 1
+    if self._index == self._size:
+      # Drop the accumulated rounding error once per round
+      self._index = 0
+      self._sum = sum(self._data)
+    else:
+      self._sum += value - old
+    return old
+
+
+  def latest(self, age=0):
+    return self._data[(self._index - 1 - age) % self._size]
+
+
+  def sum(self):
+    return self._sum
+
+
+  def mean(self):
+    return self._sum / self._size
+
+
+  def __len__(self):
+    return self._size
+
+
+class SlidingMin:
+  # Minimum of the latest `window` values of a history with up to `capacity` values
+  def __init__(self, window, capacity=None, initial=0):
+    self._capacity = int(max(window, capacity or window))
+    self._history = RingBuffer(self._capacity, initial)
+    self._count = 0
+    self._window = 0
+    self._deque = deque()
+    self.setWindow(window)
+
+
+  def _push(self, seq, value):
+    # Values in the deque are increasing, older values that are not smaller never become the minimum
+    while self._deque and self._deque[-1][1] >= value:
+      self._deque.pop()
+    self._deque.append((seq, value))
+
+
+  def append(self, value):
+    self._history.append(value)
+    self._count += 1
+    self._push(self._count, value)
+    if self._deque[0][0] <= self._count - self._window:
+      self._deque.popleft()
+
+
+  def min(self):
+    return self._deque[0][1]
+
+
+  def latest(self):
+    return self._history.latest()
+
+
+  def setWindow(self, window):
+    window = int(max(1, min(window, self._capacity)))
+    if window == self._window:
+      return
+    self._window = window
+    self._deque.clear()
+    for age in range(window - 1, -1, -1):
+      self._push(self._count - age, self._history.latest(age))
+
+
+  def getWindow(self):
+    return self._window
+
+
+class SlidingQuantile:
+  # Quantile of the latest `window` values. The values are counted in a Fenwick
+  # tree over fixed width bins, so updates and queries are O(log bins).
+  def __init__(self, window, capacity=None, binWidth=5, maxValue=20000, initial=0):
+    self._capacity = int(max(window, capacity or window))
+    self._history = RingBuffer(self._capacity, initial)
+    self._binWidth = binWidth
+    self._bins = int(maxValue // binWidth) + 1
+    self._topStep = 1 << (self._bins.bit_length() - 1)
+    self._tree = None
+    self._window = 0
+    self.setWindow(window)
+
+
+  def _bin(self, value):
+    return min(self._bins - 1, max(0, int(value // self._binWidth)))
+
+
+  def _add(self, bin, delta):
+    i = bin + 1
+    while i <= self._bins:
+      self._tree[i] += delta
+      i += i & -i
+
+
+  def append(self, value):
+    # The oldest value of the window is overwritten or leaves the window
+    self._add(self._bin(self._history.latest(self._window - 1)), -1)
+    self._history.append(value)
+    self._add(self._bin(value), 1)
+
+
+  def quantile(self, q):
+    # Lower edge of the bin holding the value with rank q of the window
+    k = int(q * (self._window - 1)) + 1
+    pos = 0
+    step = self._topStep
+    while step:
+      if pos + step <= self._bins and self._tree[pos + step] < k:
+        pos += step
+        k -= self._tree[pos]
+      step >>= 1
+    return pos * self._binWidth
+
+
+  def setWindow(self, window):
+    window = int(max(1, min(window, self._capacity)))
+    if window == self._window:
+      return
+    self._window = window
+    self._tree = array('i', [0]) * (self._bins + 1)
+    for age in range(window):
+      self._add(self._bin(self._history.latest(age)), 1)
+
+
+  def getWindow(self):
+    return self._window
+
+
+class EfficiencyCurve:
+  # Inverter efficiency over the load fraction in `bins` bins, learned from
+  # AC and DC power samples. Older samples of a bin fade out with `decay`.
+  PRIOR_WEIGHT = 3
+
+  def __init__(self, bins=20, decay=0.995):
+    self._bins = int(bins)
+    self._decay = decay
+    self._ac = array('d', [0.0]) * self._bins
+    self._dc = array('d', [0.0]) * self._bins
+    self._weight = array('d', [0.0]) * self._bins
+    self._version = 0
+    self._hull = None
+    self._hullKey = None
+    self.samples = 0
+
+
+  def _prior(self, fraction):
+    # Typical micro inverter: poor efficiency at low load, flat above 30%
+    return 0.96 - 0.07 * math.exp(-fraction / 0.1)
+
+
+  def _binEfficiency(self, b):
+    # Learned efficiency of the bin, pulled towards the prior while it has few samples
+    prior = self._prior((b + 0.5) / self._bins)
+    if self._weight[b] == 0:
+      return prior
+    learned = self._ac[b] / self._dc[b]
+    return (learned * self._weight[b] + prior * self.PRIOR_WEIGHT) / (self._weight[b] + self.PRIOR_WEIGHT)
+
+
+  def add(self, fraction, powerAC, powerDC):
+    if powerAC <= 0 or powerDC <= powerAC or fraction <= 0 or fraction > 1.2:
+      return False
+    b = min(int(fraction * self._bins), self._bins - 1)
+    self._ac[b] = self._ac[b] * self._decay + powerAC
+    self._dc[b] = self._dc[b] * self._decay + powerDC
+    self._weight[b] = self._weight[b] * self._decay + 1
+    self._version += 1
+    self.samples += 1
+    return True
+
+
+  def efficiency(self, fraction):
+    # Linear interpolation between the bin centres
+    x = min(max(fraction * self._bins - 0.5, 0), self._bins - 1)
+    b = int(x)
+    if b >= self._bins - 1:
+      return self._binEfficiency(self._bins - 1)
+    t = x - b
+    return self._binEfficiency(b) * (1 - t) + self._binEfficiency(b + 1) * t
+
+
+  def dcPower(self, power, maxPower):
+    if power <= 0:
+      return 0
+    return power / self.efficiency(power / maxPower)
+
+
+  def hull(self, minPower, maxPower):
+    # Lower convex hull of the DC power over the AC power between minPower and
+    # maxPower as a list of (power, dcPower) points with increasing slopes.
+    # Cached until the curve or the power range changes.
+    key = (self._version, minPower, maxPower)
+    if key == self._hullKey:
+      return self._hull
+
+    points = [(minPower, self.dcPower(minPower, maxPower))]
+    for k in range(1, self._bins + 1):
+      power = maxPower * k / self._bins
+      if power > minPower:
+        points.append((power, self.dcPower(power, maxPower)))
+
+    hull = []
+    for point in points:
+      while len(hull) >= 2 and (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0]) >= (point[1] - hull[-2][1]) * (hull[-1][0] - hull[-2][0]):
+        hull.pop()
+      hull.append(point)
+
+    self._hull = hull
+    self._hullKey = key
+    return hull
+
+
+################################################################################
+#                                                                              #
+#   Performance counters                                                       #
+#                                                                              #
+################################################################################
+
+# Upper bounds of the duration histogram buckets in s
+PERF_BUCKETS = [0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                5, 10, 30, 60]
+
+
+class Histogram:
+  # Durations in fixed buckets, cumulative like a Prometheus histogram. Hot
+  # paths only append to samples, they are sorted into the buckets when the
+  # histogram is read. interval() returns the statistics since its last call.
+  def __init__(self):
+    self.samples = []
+    self.counts = [0] * (len(PERF_BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0
+    self._max = 0
+    self._last = (list(self.counts), 0, 0)
+
+
+  def observe(self, value):
+    self.samples.append(value)
+
+
+  def fold(self):
+    samples, self.samples = self.samples, []
+    if len(samples) == 0:
+      return
+    for value in samples:
+      self.counts[bisect.bisect_left(PERF_BUCKETS, value)] += 1
+    self.count += len(samples)
+    self.sum += sum(samples)
+    self._max = max(self._max, max(samples))
+
+
+  def interval(self):
+    # Count, mean, 95th percentile (bucket bound) and maximum in s
+    self.fold()
+    lastCounts, lastCount, lastSum = self._last
+    count = self.count - lastCount
+    peak = self._max
+    self._last = (list(self.counts), self.count, self.sum)
+    self._max = 0
+    if count == 0:
+      return 0, 0, 0, 0
+
+    p95 = peak
+    cumulative = 0
+    for i, bound in enumerate(PERF_BUCKETS):
+      cumulative += self.counts[i] - lastCounts[i]
+      if cumulative >= 0.95 * count:
+        p95 = min(bound, peak)
+        break
+    return count, (self.sum - lastSum) / count, p95, peak
+
+
+class PerfRegistry:
+  # Counters and duration histograms of the hot paths, identified by name and
+  # a tuple of (label, value) pairs. Counters kept elsewhere are read by
+  # collectors only when they are exported.
+  def __init__(self):
+    self.counters = {}
+    self.histograms = {}
+    self._collectors = []
+
+
+  def count(self, name, labels=(), amount=1):
+    key = (name, labels)
+    self.counters[key] = self.counters.get(key, 0) + amount
+
+
+  def histogram(self, name, labels=()):
+    histogram = self.histograms.get((name, labels))
+    if histogram is None:
+      histogram = self.histograms[(name, labels)] = Histogram()
+    return histogram
+
+
+  def fold(self):
+    # Sorts the samples of all histograms into their buckets, so they do not grow
+    for histogram in list(self.histograms.values()):
+      histogram.fold()
+
+
+  def addCollector(self, collector):
+    # collector() returns a list of (name, labels, value)
+    self._collectors.append(collector)
+
+
+  def removeCollector(self, collector):
+    if collector in self._collectors:
+      self._collectors.remove(collector)
+
+
+  def total(self, name):
+    return sum(value for (counter, labels), value in self.counters.items() if counter == name)
+
+
+  def collect(self):
+    values = [(name, labels, value) for (name, labels), value in list(self.counters.items())]
+    for collector in self._collectors:
+      values.extend(collector())
+    return values
+
+
+  def writeTextfile(self, filename):
+    # Prometheus text format for the node exporter textfile collector. The
+    # file is replaced by a rename, so it is never read half written.
+    def format(name, labels, value):
+      labels = ','.join('%s="%s"' % (k, str(v).replace('"', '')) for k, v in labels)
+      return 'hm_%s%s %s\n' % (name, '{%s}' % (labels) if labels else '', value)
+
+    metrics = {}
+    for name, labels, value in self.collect():
+      metrics.setdefault(name, []).append(format(name, labels, value))
+
+    lines = []
+    for name, samples in sorted(metrics.items()):
+      lines.append('# TYPE hm_%s %s\n' % (name, 'counter' if name.endswith('_total') else 'gauge'))
+      lines.extend(samples)
+
+    self.fold()
+    histograms = {}
+    for (name, labels), histogram in list(self.histograms.items()):
+      histograms.setdefault(name, []).append((labels, histogram))
+    for name, entries in sorted(histograms.items()):
+      lines.append('# TYPE hm_%s histogram\n' % (name))
+      for labels, histogram in entries:
+        cumulative = 0
+        for bound, count in zip(PERF_BUCKETS + ['+Inf'], histogram.counts):
+          cumulative += count
+          lines.append(format(name + '_bucket', labels + (('le', bound),), cumulative))
+        lines.append(format(name + '_sum', labels, round(histogram.sum, 6)))
+        lines.append(format(name + '_count', labels, histogram.count))
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write(''.join(lines))
+    os.replace(tmp, filename)
+
+
+perf = PerfRegistry()
+
+
+################################################################################
+#                                                                              #
+#   Scheduler                                                                  #
+#                                                                              #
+################################################################################
+
+class SchedulerTask:
+  def __init__(self, name, period, callback, priority, order, idle=False):
+    self.name = name
+    self.period = period
+    self.idle = idle
+    self.once = False
+    self.callback = callback
+    self.priority = priority
+    self.order = order
+    self.deadline = 0
+    self.runs = 0
+    self.skipped = 0
+    self.lateness = 0
+    self.maxLateness = 0
+    # Tasks with the same name, e.g. the loops of all inverters, share the histogram
+    self.duration = perf.histogram('task_duration_seconds', (('task', name),))
+
+
+class Scheduler:
+  # Runs periodic tasks at monotonic deadlines from one GLib timer. Tasks due
+  # at the same time run by priority (lower first), missed runs are skipped.
+  # While the scheduler is idle, tasks added with idle=True run at the idle
+  # period instead of their own one. Tasks added with addOnce run one time.
+  def __init__(self, clock=time.monotonic):
+    self.idle = False
+    self._clock = clock
+    self._epoch = clock()
+    self._idlePeriod = 0
+    self._lateness = perf.histogram('timer_lateness_seconds')
+    self._tasks = []
+    self._taskCounter = 0
+    self._timer = None
+    self._timerDeadline = None
+
+
+  ###############################
+  # Private                     #
+  ###############################
+
+
+  def _run(self):
+    self._lateness.observe(max(0, self._clock() - self._timerDeadline))
+    self._timer = None
+    self._timerDeadline = None
+    self.runPending()
+    self._schedule()
+    return False
+
+
+  def _schedule(self):
+    if len(self._tasks) == 0:
+      return
+
+    deadline = min(task.deadline for task in self._tasks)
+    if self._timer is not None:
+      if self._timerDeadline <= deadline:
+        return
+      gobject.source_remove(self._timer)
+
+    delay = max(0, deadline - self._clock())
+    self._timerDeadline = deadline
+    self._timer = gobject.timeout_add(int(math.ceil(delay * 1000)), self._run)
+
+
+  ###############################
+  # Public                      #
+  ###############################
+
+
+  def now(self):
+    return self._clock()
+
+
+  def add(self, name, period, callback, priority=0, offset=0, idle=False):
+    # Deadlines are aligned to multiples of the period, so tasks with equal periods run together.
+    # An offset staggers tasks that should not run at the same time.
+    self._taskCounter += 1
+    task = SchedulerTask(name, period, callback, priority, self._taskCounter, idle)
+    now = self._clock()
+    task.deadline = self._epoch + offset + (math.floor((now - self._epoch - offset) / period) + 1) * period
+    self._tasks.append(task)
+    self._schedule()
+    return task
+
+
+  def addOnce(self, name, delay, callback, priority=0):
+    self._taskCounter += 1
+    task = SchedulerTask(name, delay, callback, priority, self._taskCounter)
+    task.once = True
+    task.deadline = self._clock() + delay
+    self._tasks.append(task)
+    self._schedule()
+    return task
+
+
+  def remove(self, task):
+    if task in self._tasks:
+      self._tasks.remove(task)
+
+
+  def runPending(self):
+    now = self._clock()
+    # Tolerate timers firing a little early because of the ms resolution
+    due = [task for task in self._tasks if task.deadline <= now + 0.002]
+    due.sort(key=lambda task: (task.priority, task.order))
+
+    perfCounter = time.perf_counter
+    start = perfCounter()
+    for task in due:
+      task.lateness = max(0, now - task.deadline)
+      task.maxLateness = max(task.maxLateness, task.lateness)
+      task.runs += 1
+
+      if task.once:
+        self._tasks.remove(task)
+
+      period = self.getPeriod(task)
+      task.deadline += period
+      if task.deadline <= now:
+        missed = int((now - task.deadline) // period) + 1
+        task.deadline += missed * period
+        task.skipped += missed
+
+      try:
+        task.callback()
+      except Exception as e:
+        perf.count('exceptions_total', (('at', task.name),))
+        logging.critical('Error at %s', task.name, exc_info=e)
+
+      end = perfCounter()
+      task.duration.samples.append(end - start)
+      start = end
+
+
+  def getTasks(self):
+    return list(self._tasks)
+
+
+  def getPeriod(self, task):
+    if self.idle and task.idle:
+      return max(task.period, self._idlePeriod)
+    return task.period
+
+
+  def setIdlePeriod(self, period):
+    self._idlePeriod = period
+
+
+  def setIdle(self, idle):
+    if idle == self.idle:
+      return
+
+    self.idle = idle
+    if idle == False:
+      # Run the slowed down tasks at once
+      now = self._clock()
+      for task in self._tasks:
+        if task.idle:
+          task.deadline = min(task.deadline, now)
+      self._schedule()
+
+
+  def wake(self):
+    # Also used as idle callback from other threads
+    self.setIdle(False)
+    return False
+
+
+################################################################################
+#                                                                              #
+#   Trace                                                                      #
+#                                                                              #
+################################################################################
+
+# Trace channels
+TRACE_GRID = 1                  # 1..3: grid power L1..L3
+TRACE_CONSUMPTION = 4           # 4..6: consumption L1..L3
+TRACE_PV = 7                    # DC PV power
+TRACE_LIMIT = 10                # total limit requested by _setLimit
+TRACE_LIMIT_MODE = 11
+TRACE_PHASE_LIMIT = 12          # 12..14: limit of L1..L3 requested in per phase mode
+TRACE_MAX_INVERTERS = 1000      # channels of each inverter group, inverters above are not recorded
+TRACE_INVERTER_POWER = 1000     # + device index: inverter AC power
+TRACE_INVERTER_PHASE = 2000     # + device index: inverter phase
+TRACE_INVERTER_MAXPOWER = 3000  # + device index: inverter maximum power
+
+# Inverter groups of version 1 trace files, 50 channels each
+_TRACE_V1_GROUPS = {100: TRACE_INVERTER_POWER, 150: TRACE_INVERTER_PHASE, 200: TRACE_INVERTER_MAXPOWER}
+
+_TRACE_PATHS = {
+  '/Ac/Grid/L1/Power':          TRACE_GRID,
+  '/Ac/Grid/L2/Power':          TRACE_GRID + 1,
+  '/Ac/Grid/L3/Power':          TRACE_GRID + 2,
+  '/Ac/Consumption/L1/Power':   TRACE_CONSUMPTION,
+  '/Ac/Consumption/L2/Power':   TRACE_CONSUMPTION + 1,
+  '/Ac/Consumption/L3/Power':   TRACE_CONSUMPTION + 2,
+  '/Dc/Pv/Power':               TRACE_PV,
+}
+
+
+class TraceRecorder:
+  # Records value changes as 10 byte records (ms since start, channel, float value)
+  MAGIC = b'HMTR\x02'
+  MAGIC_V1 = b'HMTR\x01'
+  HEADER = struct.Struct('<5sd')
+  RECORD = struct.Struct('<IHf')
+  RECORD_V1 = struct.Struct('<IBf')
+
+  def __init__(self, filename, clock):
+    self.filename = filename
+    self._clock = clock
+    self._start = clock()
+    self._last = {}
+    self._buffer = bytearray(self.HEADER.pack(self.MAGIC, time.time()))
+    self._file = open(filename, 'wb')
+    self.records = 0
+
+
+  def record(self, channel, value):
+    if value is None or self._last.get(channel) == value:
+      return
+    self._last[channel] = value
+    self._buffer += self.RECORD.pack(int((self._clock() - self._start) * 1000), channel, value)
+    self.records += 1
+    if len(self._buffer) >= 65536:
+      self.flush()
+
+
+  def flush(self):
+    # Written in large blocks to spare the SD card
+    if self._buffer:
+      self._file.write(self._buffer)
+      self._file.flush()
+      self._buffer = bytearray()
+
+
+  def close(self):
+    self.flush()
+    self._file.close()
+
+
+  @classmethod
+  def read(cls, filename):
+    # Returns the wall clock start time and a list of (seconds, channel, value)
+    with open(filename, 'rb') as f:
+      data = f.read()
+    magic, startTime = cls.HEADER.unpack_from(data, 0)
+    if magic == cls.MAGIC:
+      record = cls.RECORD
+    elif magic == cls.MAGIC_V1:
+      record = cls.RECORD_V1
+    else:
+      raise ValueError("%s is not a trace file" % (filename))
+    records = [(ms / 1000, channel, value) for ms, channel, value in record.iter_unpack(data[cls.HEADER.size:len(data) - (len(data) - cls.HEADER.size) % record.size])]
+    if magic == cls.MAGIC_V1:
+      records = [(t, cls._channelV1(channel), value) for t, channel, value in records]
+    return startTime, records
+
+
+  @staticmethod
+  def _channelV1(channel):
+    for first, group in _TRACE_V1_GROUPS.items():
+      if first <= channel < first + 50:
+        return group + channel - first
+    return channel
+
+
+################################################################################
+#                                                                              #
+#   Profiler                                                                   #
+#                                                                              #
+################################################################################
+
+PROFILE_INTERVAL = 0.01           # s between two samples
+PROFILE_DEFAULT_DURATION = 30     # s, profile started by SIGUSR1
+PROFILE_MAX_DURATION = 600        # s
+
+
+class SamplingProfiler:
+  # Samples the stacks of all other threads (GLib main loop, paho, HTTP
+  # pollers) from its own thread and writes them in the collapsed stack
+  # format of flamegraph.pl and speedscope. Nothing runs unless a profile is
+  # requested.
+  def __init__(self, filename, duration, done):
+    self.filename = filename
+    self.samples = 0
+    self._duration = min(duration, PROFILE_MAX_DURATION)
+    self._done = done
+    self._stacks = {}
+    self._stop = Event()
+    self._thread = Thread(target=self._run, name='profiler', daemon=True)
+    self._thread.start()
+
+
+  def _run(self):
+    own = threading.get_ident()
+    names = {}
+    end = time.monotonic() + self._duration
+    while not self._stop.wait(PROFILE_INTERVAL) and time.monotonic() < end:
+      if self.samples % 100 == 0:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+      for ident, frame in sys._current_frames().items():
+        if ident == own:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+          frame = frame.f_back
+        stack.append(names.get(ident, str(ident)))
+        key = ';'.join(reversed(stack))
+        self._stacks[key] = self._stacks.get(key, 0) + 1
+      self.samples += 1
+
+    try:
+      with open(self.filename, 'w') as f:
+        for stack, count in sorted(self._stacks.items()):
+          f.write('%s %d\n' % (stack, count))
+    except Exception as e:
+      logging.critical('Error at %s', 'profile %s' % (self.filename), exc_info=e)
+
+    # Report back on the GLib main loop
+    gobject.idle_add(self._done, self)
+
+
+  def stop(self):
+    self._stop.set()
+
+
+################################################################################
+#                                                                              #
+#   Limit allocation                                                           #
+#                                                                              #
+################################################################################
+
+# An allocator splits a total limit over the inverters. It gets the minimum and
+# maximum power, the current limit and the active state of the inverters as
+# lists (index 0 is the master inverter, or the first active inverter of the
+# phase with a limit per phase) together with their efficiency curves and
+# returns the new limit of every inverter, or None for inverters whose limit
+# is not changed.
+
+NUMPY_MIN_INVERTERS = 16
+
+
+def allocatePrimary(newLimit, minPower, maxPower, limit, active, curves):
+  # The master inverter follows the limit, the other inverters are moved as a block
+  count = len(maxPower)
+  secondary = [i for i in range(1, count) if active[i]]
+  secondaryMinPower = sum(minPower[i] for i in secondary)
+  secondaryMaxPower = sum(maxPower[i] for i in secondary)
+  secondaryPowerLimit = sum(limit[i] for i in secondary)
+  result = [None] * count
+
+  if newLimit >= maxPower[0] + secondaryMaxPower:
+    for i in range(count):
+      if active[i]:
+        result[i] = maxPower[i]
+
+  elif newLimit <= minPower[0] + secondaryMinPower:
+    for i in range(count):
+      if active[i]:
+        result[i] = minPower[i]
+
+  elif maxPower[0] >= newLimit - secondaryPowerLimit and minPower[0] <= newLimit - secondaryPowerLimit:
+    result[0] = newLimit - secondaryPowerLimit
+
+  else:
+    if newLimit <= maxPower[0]/2 + secondaryMinPower:
+      for i in secondary:
+        result[i] = minPower[i]
+    elif newLimit >= maxPower[0]/2 + secondaryMaxPower:
+      for i in secondary:
+        result[i] = maxPower[i]
+    else:
+      for i in secondary:
+        result[i] = int((newLimit - maxPower[0]/2) * maxPower[i] / secondaryMaxPower)
+    result[0] = newLimit - sum(int(min(max(result[i], minPower[i]), maxPower[i])) for i in secondary)
+
+  return result
+
+
+def allocateFewestChanges(newLimit, minPower, maxPower, limit, active, curves):
+  # The inverters with the most room in the direction of the change take it
+  # first, so only as many inverters as necessary get a new limit
+  count = len(maxPower)
+  indices = [i for i in range(count) if active[i]]
+  result = [None] * count
+  current = {}
+  for i in indices:
+    current[i] = min(max(limit[i], minPower[i]), maxPower[i])
+    if current[i] != limit[i]:
+      result[i] = current[i]
+
+  total = min(max(newLimit, sum(minPower[i] for i in indices)), sum(maxPower[i] for i in indices))
+  delta = total - sum(current.values())
+
+  if delta > 0:
+    indices.sort(key=lambda i: current[i] - maxPower[i])
+    for i in indices:
+      if delta <= 0:
+        break
+      step = min(delta, maxPower[i] - current[i])
+      result[i] = current[i] + step
+      delta -= step
+
+  elif delta < 0:
+    indices.sort(key=lambda i: minPower[i] - current[i])
+    for i in indices:
+      if delta >= 0:
+        break
+      step = min(-delta, current[i] - minPower[i])
+      result[i] = current[i] - step
+      delta += step
+
+  return result
+
+
+def allocateBalanced(newLimit, minPower, maxPower, limit, active, curves):
+  # Water filling: all inverters run at the same fraction of their maximum
+  # power, inverters below their minimum power stay at the minimum
+  count = len(maxPower)
+  indices = [i for i in range(count) if active[i] and maxPower[i] > 0]
+  result = [None] * count
+  if not indices:
+    return result
+
+  lows = [minPower[i] for i in indices]
+  highs = [maxPower[i] for i in indices]
+  if numpy is not None and len(indices) >= NUMPY_MIN_INVERTERS:
+    level = _waterLevelNumpy(newLimit, lows, highs)
+  else:
+    level = _waterLevel(newLimit, lows, highs)
+
+  for i in indices:
+    result[i] = min(max(level * maxPower[i], minPower[i]), maxPower[i])
+  return result
+
+
+def _waterLevel(total, minPower, maxPower):
+  # Fraction l with sum(clip(l * max, min, max)) == total. An inverter leaves
+  # its minimum power at l = min / max, between these breakpoints the sum is linear.
+  if total >= sum(maxPower):
+    return 1.0
+  fixed = sum(minPower)   # inverters still at their minimum power
+  scaled = 0              # maximum power of the inverters above their minimum
+  for point, low, high in sorted(zip([min(l / h, 1.0) for l, h in zip(minPower, maxPower)], minPower, maxPower)):
+    if fixed + point * scaled >= total:
+      break
+    fixed -= low
+    scaled += high
+  if scaled == 0:
+    return 0.0
+  return min((total - fixed) / scaled, 1.0)
+
+
+def _waterLevelNumpy(total, minPower, maxPower):
+  lows = numpy.asarray(minPower, dtype=float)
+  highs = numpy.asarray(maxPower, dtype=float)
+  if total >= highs.sum():
+    return 1.0
+  points = numpy.minimum(lows / highs, 1.0)
+  order = numpy.argsort(points, kind='stable')
+  points, lows, highs = points[order], lows[order], highs[order]
+  # sum of the allocation at every breakpoint, non decreasing
+  fixed = lows.sum() - numpy.concatenate(([0.0], numpy.cumsum(lows)[:-1]))
+  scaled = numpy.concatenate(([0.0], numpy.cumsum(highs)[:-1]))
+  k = int(numpy.searchsorted(fixed + points * scaled, total, side='left'))
+  if k == len(points):
+    fixed, scaled = 0.0, highs.sum()
+  else:
+    fixed, scaled = fixed[k], scaled[k]
+  if scaled == 0:
+    return 0.0
+  return float(min((total - fixed) / scaled, 1.0))
+
+
+def allocateEfficient(newLimit, minPower, maxPower, limit, active, curves):
+  # Lowest DC power for the requested AC power: starting at the minimum power
+  # of every inverter, the segment of the convex hull of all DC power curves
+  # with the lowest marginal DC power per W AC is filled next. Concave parts
+  # of a curve are skipped, so fewer inverters run at a higher load instead of
+  # many at a poor efficiency.
+  count = len(maxPower)
+  indices = [i for i in range(count) if active[i] and maxPower[i] > 0]
+  result = [None] * count
+  if not indices:
+    return result
+
+  hulls = {}
+  power = {}
+  for i in indices:
+    curve = curves[i] if curves[i] is not None else EfficiencyCurve()
+    hulls[i] = curve.hull(minPower[i], maxPower[i])
+    power[i] = minPower[i]
+
+  remaining = min(newLimit, sum(maxPower[i] for i in indices)) - sum(power.values())
+  heap = []
+
+  def push(i, segment):
+    hull = hulls[i]
+    if segment + 1 < len(hull):
+      (p0, d0), (p1, d1) = hull[segment], hull[segment + 1]
+      heapq.heappush(heap, ((d1 - d0) / (p1 - p0), i, segment))
+
+  for i in indices:
+    push(i, 0)
+
+  while remaining > 0 and heap:
+    slope, i, segment = heapq.heappop(heap)
+    step = min(hulls[i][segment + 1][0] - power[i], remaining)
+    power[i] += step
+    remaining -= step
+    push(i, segment + 1)
+
+  for i in indices:
+    result[i] = power[i]
+  return result
+
+
+LIMIT_ALLOCATORS = {
+  0: allocatePrimary,
+  1: allocateFewestChanges,
+  2: allocateBalanced,
+  3: allocateEfficient,
+}
+
+
+################################################################################
+#                                                                              #
+#   MQTT                                                                       #
+#                                                                              #
+################################################################################
+
+COMMAND_POWER = 0       # inverter on/off
+COMMAND_LIMIT = 1       # limit changes
+COMMAND_REFRESH = 2     # periodic resend of an unchanged limit
+
+
+class CommandQueue:
+  # Commands to one DTU. The DTU sends one command at a time over the radio,
+  # so commands are sent with a minimum spacing. A newer payload for a topic
+  # replaces the pending one, power commands are sent before limits.
+  def __init__(self, connection, scheduler, spacing):
+    self._connection = connection
+    self._scheduler = scheduler
+    self._pending = {}      # topic: [priority, order, payload, sent callback]
+    self._order = 0
+    self._lastSent = None
+    self._spacing = 0
+    self._task = None
+    self.sent = 0
+    self.superseded = 0
+    self.maxDepth = 0
+    self.setSpacing(spacing)
+
+
+  ###############################
+  # Private                     #
+  ###############################
+
+
+  def _sendNext(self):
+    if len(self._pending) == 0:
+      return
+
+    now = self._scheduler.now()
+    if self._lastSent is not None and now - self._lastSent < self._spacing - 0.002:
+      self._arm(self._lastSent + self._spacing - now)
+      return
+
+    topic = min(self._pending, key=lambda t: self._pending[t][:2])
+    priority, order, payload, sent = self._pending.pop(topic)
+    self._lastSent = now
+    self._connection.publish(topic, payload)
+    self.sent += 1
+    if sent is not None:
+      sent(now)
+    if self._pending and self._spacing > 0:
+      self._arm(self._spacing)
+
+
+  def _arm(self, delay):
+    # The timer only runs while commands wait for the spacing
+    if self._task is None:
+      self._task = self._scheduler.addOnce('_sendCommand', delay, self._sendTimer, 0)
+
+
+  def _sendTimer(self):
+    self._task = None
+    self._sendNext()
+
+
+  ###############################
+  # Public                      #
+  ###############################
+
+
+  def put(self, topic, payload, priority=COMMAND_LIMIT, sent=None):
+    # sent is called with the time the command is published
+    entry = self._pending.get(topic)
+    if entry is not None:
+      self.superseded += 1
+      entry[0] = min(entry[0], priority)
+      entry[2] = payload
+      entry[3] = sent
+    else:
+      self._order += 1
+      self._pending[topic] = [priority, self._order, payload, sent]
+
+    self._sendNext()
+    self.maxDepth = max(self.maxDepth, len(self._pending))
+
+
+  def setSpacing(self, spacing):
+    if self._task is not None:
+      self._scheduler.remove(self._task)
+      self._task = None
+
+    self._spacing = spacing
+    if spacing > 0:
+      self._sendNext()
+    else:
+      while self._pending:
+        self._sendNext()
+
+
+  def getDepth(self):
+    return len(self._pending)
+
+
+  def close(self):
+    if self._task is not None:
+      self._scheduler.remove(self._task)
+      self._task = None
+    self._pending.clear()
+
+
+MQTT_DISCONNECTED = 0
+MQTT_CONNECTING = 1
+MQTT_CONNECTED = 2
+MQTT_STATES = ['Disconnected', 'Connecting', 'Connected']
+MQTT_RECONNECT_MAX = 120     # s, maximum reconnect delay
+
+
+class MqttConnection:
+  # Connects in the paho network thread, so a broker that is down never
+  # blocks the GLib main loop. paho retries with an exponential backoff,
+  # starting at a random delay per client so clients do not reconnect in step.
+  def __init__(self, url, name, scheduler, commandSpacing=0):
+    self.url = url
+    self.connected = 0
+    self.state = MQTT_CONNECTING
+    self.connects = 0
+    self.disconnects = 0
+    self._inverters = []
+    self._routes = {}
+    self._publishLock = Lock()
+    self._scheduler = scheduler
+    self._commandSpacing = commandSpacing
+    self._commandQueues = {}
+
+    self._client = mqtt.Client(name) # create new instance
+    self._client.on_disconnect = self._on_MQTT_disconnect
+    self._client.on_connect = self._on_MQTT_connect
+    self._client.on_message = self._on_MQTT_message
+    self._resetBackoff()
+    try:
+      self._client.connect_async(self.url)  # connected by the network thread
+    except Exception as e:
+      logging.critical('Error at %s', 'MQTT connect %s' % (self.url), exc_info=e)
+      self.state = MQTT_DISCONNECTED
+    self._client.loop_start()
+
+
+  ###############################
+  # Private                     #
+  ###############################
+
+
+  def _resetBackoff(self):
+    self._client.reconnect_delay_set(min_delay=random.uniform(1, 2), max_delay=MQTT_RECONNECT_MAX)
+
+
+  def _setState(self, state):
+    # Called by the paho thread, the inverters are notified on the GLib main loop
+    self.state = state
+    gobject.idle_add(self._notifyState)
+
+
+  def _notifyState(self):
+    for inverter in self._inverters:
+      inverter.mqttStateChanged()
+    return False
+
+
+  def _on_MQTT_disconnect(self, client, userdata, rc):
+    self.connected = 0
+    self.disconnects += 1
+    if rc != 0:
+      logging.warning("MQTT %s disconnected unexpectedly (%s), reconnecting" % (self.url, rc))
+      self._setState(MQTT_CONNECTING)
+    else:
+      logging.info("MQTT %s disconnected" % (self.url))
+      self._setState(MQTT_DISCONNECTED)
+
+
+  def _on_MQTT_connect(self, client, userdata, flags, rc):
+    if rc == 0:
+        self.connected = 1
+        self.connects += 1
+        self._resetBackoff()
+        logging.info("MQTT %s connected" % (self.url))
+
+        for topic in self._routes:
+          client.subscribe(topic)
+        self._setState(MQTT_CONNECTED)
+
+    else:
+        logging.warning("MQTT %s connection refused, return code %s" % (self.url, rc))
+
+
+  def _on_MQTT_message(self, client, userdata, msg):
+    for inverter in self._routes.get(msg.topic, ()):
+      inverter._on_MQTT_message(client, userdata, msg)
+
+
+  ###############################
+  # Public                      #
+  ###############################
+
+
+  def register(self, inverter):
+    if inverter not in self._inverters:
+      self._inverters.append(inverter)
+    self.updateRoutes()
+
+
+  def unregister(self, inverter):
+    if inverter in self._inverters:
+      self._inverters.remove(inverter)
+    self.updateRoutes()
+    return len(self._inverters)
+
+
+  def updateRoutes(self):
+    # Route every subscribed topic to the inverters using it, (un)subscribe the differences
+    routes = {}
+    for inverter in self._inverters:
+      for topic in inverter._topicIndex:
+        routes[topic] = routes.get(topic, ()) + (inverter,)
+
+    oldRoutes = self._routes
+    self._routes = routes
+
+    if self.connected == 1:
+      for topic in routes.keys() - oldRoutes.keys():
+        self._client.subscribe(topic)
+      for topic in oldRoutes.keys() - routes.keys():
+        self._client.unsubscribe(topic)
+
+
+  def publish(self, topic, payload):
+    with self._publishLock:
+      self._client.publish(topic, payload)
+
+
+  def commandQueue(self, dtu):
+    # One command queue per DTU, identified by the topic prefix of its inverters
+    queue = self._commandQueues.get(dtu)
+    if queue is None:
+      queue = CommandQueue(self, self._scheduler, self._commandSpacing)
+      self._commandQueues[dtu] = queue
+    return queue
+
+
+  def setCommandSpacing(self, spacing):
+    self._commandSpacing = spacing
+    for queue in self._commandQueues.values():
+      queue.setSpacing(spacing)
+
+
+  def getCommandQueues(self):
+    return dict(self._commandQueues)
+
+
+  def close(self):
+    for queue in self._commandQueues.values():
+      queue.close()
+    self.state = MQTT_DISCONNECTED
+    # Stopping the network thread waits for a pending connect, do it in the background
+    self._client.disconnect()
+    Thread(target=self._client.loop_stop, daemon=True).start()
+
+
+class MqttConnectionPool:
+  def __init__(self, name, scheduler):
+    self._name = name
+    self._scheduler = scheduler
+    self._connections = {}
+    self._clientCounter = 0
+    self._commandSpacing = 0
+
+
+  def acquire(self, url, inverter):
+    # One client and network thread per broker, shared by all inverters using it
+    connection = self._connections.get(url)
+    if connection is None:
+      self._clientCounter += 1
+      connection = MqttConnection(url, "{}-{}".format(self._name, self._clientCounter), self._scheduler, self._commandSpacing)
+      self._connections[url] = connection
+      logging.info("MQTT connection %s created" % (url))
+
+    connection.register(inverter)
+    return connection
+
+
+  def release(self, connection, inverter):
+    if connection.unregister(inverter) == 0:
+      self._connections.pop(connection.url, None)
+      connection.close()
+      logging.info("MQTT connection %s closed" % (connection.url))
+
+
+  def setCommandSpacing(self, spacing):
+    self._commandSpacing = spacing
+    for connection in self._connections.values():
+      connection.setCommandSpacing(spacing)
+
+
+  def getConnections(self):
+    return list(self._connections.values())
+
+
+class InverterFrame:
+  # Values of one DTU update. The paho thread collects the values of a frame
+  # and replaces the published snapshot as a whole, the GLib main loop always
+  # reads a complete frame without locking.
+  def __init__(self, values):
+    self._values = dict(values)
+    self._received = set()
+    self._expected = set()
+    self._readSeq = 0
+    self.snapshot = (0, dict(values))
+    self.superseded = 0
+
+
+  def update(self, key, value):
+    # Called by the paho thread, returns True if a frame was completed
+    committed = False
+    if key in self._received:
+      # A value of the current frame arrives again, so a new frame has started
+      committed = self._commit()
+
+    self._values[key] = value
+    self._received.add(key)
+
+    if self._expected and self._received >= self._expected:
+      committed = self._commit()
+
+    return committed
+
+
+  def replace(self, values):
+    # Called by the HTTP poller thread with all values of one DTU update
+    self._values.update(values)
+    self._received = set(values)
+    return self._commit()
+
+
+  def _commit(self):
+    if len(self._received) == 0:
+      return False
+
+    # The keys of this frame are expected to complete the next one
+    self._expected = self._received
+    self._received = set()
+    self.snapshot = (self.snapshot[0] + 1, dict(self._values))
+    return True
+
+
+  def read(self):
+    # Called by the GLib main loop, returns the values of the latest frame
+    seq, values = self.snapshot
+    if seq > self._readSeq + 1:
+      self.superseded += seq - self._readSeq - 1
+    self._readSeq = max(seq, self._readSeq)
+    return values
+
+
+  def getSeq(self):
+    return self.snapshot[0]
+
+
+################################################################################
+#                                                                              #
+#   HTTP                                                                       #
+#                                                                              #
+################################################################################
+
+TRANSPORT_MQTT = 0
+TRANSPORT_HTTP = 1
+
+HTTP_POLL_MIN = 2      # s, poll interval while the DTU reports new values
+HTTP_POLL_MAX = 30     # s, poll interval of a quiet or unreachable DTU
+HTTP_TIMEOUT = 5       # s
+
+# Ahoy field names of /api/live that differ from the MQTT topics
+_AHOY_FIELDS = {'F_AC': 'Freq'}
+
+# Fields of /api/livedata/status for the OpenDTU MQTT topics. The inverter
+# values moved from 'AC' to 'INV' with newer firmware, the first match is used.
+_OPENDTU_FIELDS = {
+  '0/power':        [('AC', 'Power')],
+  '0/voltage':      [('AC', 'Voltage')],
+  '0/current':      [('AC', 'Current')],
+  '0/frequency':    [('AC', 'Frequency')],
+  '0/powerdc':      [('INV', 'Power DC'), ('AC', 'Power DC')],
+  '0/yieldtotal':   [('INV', 'YieldTotal'), ('AC', 'YieldTotal')],
+  '0/efficiency':   [('INV', 'Efficiency'), ('AC', 'Efficiency')],
+  '0/temperature':  [('INV', 'Temperature'), ('AC', 'Temperature')],
+}
+for i in range(1, 5):
+  # DC inputs are numbered from 1 in MQTT and from 0 in the livedata
+  _OPENDTU_FIELDS[f'{i}/voltage'] = [('DC', 'Voltage', str(i - 1))]
+  _OPENDTU_FIELDS[f'{i}/current'] = [('DC', 'Current', str(i - 1))]
+
+
+class HttpPoller:
+  # Polls the livedata of all inverters of one DTU in its own thread over one
+  # keep-alive session. After new values the DTU is polled again after
+  # HTTP_POLL_MIN, the interval grows while it has nothing new or is unreachable.
+  def __init__(self, url, dtu):
+    self.url = url
+    self.dtu = dtu
+    self.interval = HTTP_POLL_MIN
+    self.requests = 0
+    self.errors = 0
+    self._baseUrl = url.rstrip('/') if '://' in url else 'http://' + url.rstrip('/')
+    self._inverters = []
+    self._lock = Lock()
+    self._stop = Event()
+    self._updated = {}
+    self._ahoyFields = None
+    self._reachable = True
+    self._session = requests.Session()
+    self._thread = None
+
+
+  ###############################
+  # Private                     #
+  ###############################
+
+
+  def _run(self):
+    while not self._stop.is_set():
+      try:
+        if self._poll():
+          self.interval = HTTP_POLL_MIN
+        else:
+          self.interval = min(self.interval * 1.5, HTTP_POLL_MAX)
+        if not self._reachable:
+          self._reachable = True
+          logging.info("DTU %s reachable" % (self.url))
+
+      except Exception as e:
+        self.errors += 1
+        self.interval = min(self.interval * 2, HTTP_POLL_MAX)
+        if self._reachable:
+          self._reachable = False
+          self._ahoyFields = None
+          logging.warning("DTU %s not reachable: %s" % (self.url, e))
+
+      self._stop.wait(self.interval)
+    self._session.close()
+
+
+  def _get(self, path, params=None):
+    self.requests += 1
+    response = self._session.get(self._baseUrl + path, params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+  def _poll(self):
+    # Returns True if any inverter got a new frame
+    with self._lock:
+      inverters = {inverter.getHttpId(): inverter for inverter in self._inverters}
+
+    if self.dtu == 0:
+      frames = self._pollAhoy(inverters)
+    else:
+      frames = self._pollOpenDtu(inverters)
+
+    for id, (values, limitKey, limit) in frames.items():
+      inverters[id].httpFrame(values, limitKey, limit)
+    return len(frames) > 0
+
+
+  def _isNew(self, id, updated, tolerance=0):
+    # Only values the DTU received since the last poll make a new frame
+    last = self._updated.get(id)
+    if last is not None and abs(updated - last) <= tolerance:
+      return False
+    self._updated[id] = updated
+    return True
+
+
+  def _pollAhoy(self, inverters):
+    if self._ahoyFields is None:
+      live = self._get('/api/live')
+      self._ahoyFields = (live['ch0_fld_names'], live['fld_names'])
+
+    frames = {}
+    for id in inverters:
+      data = self._get('/api/inverter/id/%d' % (id))
+      if not self._isNew(id, data.get('ts_last_success')):
+        continue
+
+      values = {}
+      for channel, fields in enumerate(data['ch']):
+        names = self._ahoyFields[0] if channel == 0 else self._ahoyFields[1]
+        for name, value in zip(names, fields):
+          values[f'ch{channel}/{_AHOY_FIELDS.get(name, name)}'] = value
+      frames[id] = (values, 'ch0/active_PowerLimit', data.get('power_limit_read'))
+    return frames
+
+
+  def _pollOpenDtu(self, inverters):
+    status = self._get('/api/livedata/status')
+    now = time.monotonic()
+
+    frames = {}
+    for data in status.get('inverters', ()):
+      serial = str(data.get('serial'))
+      if serial not in inverters:
+        continue
+      # data_age is the age of the last values in s, data_age_ms in newer firmware
+      age = data['data_age_ms'] / 1000 if 'data_age_ms' in data else data.get('data_age', 0)
+      if not self._isNew(serial, now - age, 1.5):
+        continue
+      if 'AC' not in data:
+        # Newer firmware only returns the values of one inverter per request
+        data = self._get('/api/livedata/status', {'inv': serial})['inverters'][0]
+
+      values = {}
+      for key, fields in _OPENDTU_FIELDS.items():
+        for field in fields:
+          section = data.get(field[0], {}).get(field[2] if len(field) > 2 else '0', {})
+          if field[1] in section:
+            values[key] = section[field[1]]['v']
+            break
+      frames[serial] = (values, 'status/limit_absolute', data.get('limit_absolute'))
+    return frames
+
+
+  ###############################
+  # Public                      #
+  ###############################
+
+
+  def register(self, inverter):
+    with self._lock:
+      if inverter not in self._inverters:
+        self._inverters.append(inverter)
+    self.interval = HTTP_POLL_MIN
+
+    if self._thread is None:
+      self._thread = Thread(target=self._run, daemon=True)
+      self._thread.start()
+
+
+  def unregister(self, inverter):
+    with self._lock:
+      if inverter in self._inverters:
+        self._inverters.remove(inverter)
+      return len(self._inverters)
+
+
+  def close(self):
+    self._stop.set()
+
 
+class HttpPollerPool:
+  def __init__(self):
+    self._pollers = {}
 
-def new_service(base, type, physical, logical, id, instance):
-    if instance == 0:
-      self =  VeDbusService("{}.{}".format(base, type), dbusconnection())
-    else:
-      self =  VeDbusService("{}.{}.{}_id{:02d}".format(base, type, physical,  id), dbusconnection())
-    # physical is the physical connection
-    # logical is the logical connection to align with the numbering of the console display
-    # Create the management objects, as specified in the ccgx dbus-api document
-    self.add_path('/Mgmt/ProcessName', __file__)
-    self.add_path('/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
-    self.add_path('/Mgmt/Connection', logical)
 
-    # Create the mandatory objects, note these may need to be customised after object creation
-    self.add_path('/DeviceInstance', instance)
-    self.add_path('/ProductId', 0)
-    self.add_path('/ProductName', '')
-    self.add_path('/FirmwareVersion', 0)
-    self.add_path('/HardwareVersion', 0)
-    self.add_path('/Connected', 0)  # Mark devices as disconnected until they are confirmed
-    self.add_path('/Serial', 0)
+  def acquire(self, url, dtu, inverter):
+    # One poller and session per DTU, shared by all inverters behind it
+    poller = self._pollers.get((url, dtu))
+    if poller is None:
+      poller = HttpPoller(url, dtu)
+      self._pollers[(url, dtu)] = poller
+      logging.info("HTTP poller %s created" % (url))
 
-    return self
+    poller.register(inverter)
+    return poller
 
 
-def getConfig():
-  config = configparser.ConfigParser()
-  config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
-  return config;
+  def release(self, poller, inverter):
+    if poller.unregister(inverter) == 0:
+      self._pollers.pop((poller.url, poller.dtu), None)
+      poller.close()
+      logging.info("HTTP poller %s closed" % (poller.url))
+
+
+  def getPollers(self):
+    return list(self._pollers.values())
 
 
 ################################################################################
@@ -92,13 +1710,77 @@ def getConfig():
 #                                                                              #
 ################################################################################
 
+LIMIT_ACK_TIMEOUT = 15   # seconds until a limit not reported as applied by the DTU is resent
+LIMIT_RESEND_MAX = 3     # resends without a matching report until the reported limits are ignored
+LIMIT_TRACE_TIMEOUT = 60 # seconds until a limit trace without power response is closed
+LIMIT_TRACE_STAGES = ['decision', 'publish', 'ack', 'response', 'total']
+_LIMIT_LATENCY = {stage: perf.histogram('limit_latency_seconds', (('stage', stage),)) for stage in LIMIT_TRACE_STAGES}
+
+# Inverter values summed up for the master inverter
+FLEET_PATHS = [
+  '/Ac/Inverter/L1/P', '/Ac/Inverter/L2/P', '/Ac/Inverter/L3/P',
+  '/Ac/Inverter/L1/I', '/Ac/Inverter/L2/I', '/Ac/Inverter/L3/I',
+  '/Dc/1/Power', '/Dc/1/Current',
+]
+
+
+class FleetTotals:
+  # Running totals of the inverter values. Every inverter adds the change of
+  # its own values, so the totals cost O(1) per change instead of a loop over
+  # all inverters on every update.
+  def __init__(self):
+    self.totals = dict.fromkeys(FLEET_PATHS, 0)
+    self.changed = True
+
+
+  def add(self, path, delta):
+    self.totals[path] += delta
+    self.changed = True
+
+
+  def reset(self, totals):
+    # Full recompute, drops the rounding errors accumulated by add
+    self.totals = totals
+    self.changed = True
+
+
+class LimitTrace:
+  # Monotonic timestamps of one limit change of one inverter: grid sample,
+  # decision in _setLimit, publish to the DTU, DTU ack and power response
+  __slots__ = ('id', 'limit', 'power', 'sample', 'decision', 'publish', 'ack', 'response')
+
+  def __init__(self, id, sample, decision, limit, power):
+    self.id = id
+    self.limit = limit
+    self.power = power
+    self.sample = sample
+    self.decision = decision
+    self.publish = None
+    self.ack = None
+    self.response = None
+
+
+  def latencies(self):
+    # Duration of every stage in s, None for stages not reached
+    def between(start, end):
+      return end - start if start is not None and end is not None else None
+    return {
+      'decision': between(self.sample, self.decision),
+      'publish':  between(self.decision, self.publish),
+      'ack':      between(self.publish, self.ack),
+      'response': between(self.publish, self.response),
+      'total':    between(self.sample, self.response),
+    }
+
+
 class DbusHmInverterService:
-  def __init__(self, deviceinstance, dbusmonitor):
+  def __init__(self, deviceinstance, dbusmonitor, mqttPool, scheduler, fleet=None, httpPool=None):
 
     self.settings = None
-    self._inverterLoopCounter = 0
+    self._scheduler = scheduler
     self._deviceinstance = deviceinstance
     self._active = False
+    self._updateScheduled = False
     self._inverterData = {}
     
     # Ahoy
@@ -131,17 +1813,44 @@ class DbusHmInverterService:
     for i in range(1, 5):
       self._inverterData[1][f'{i}/current'] = 0
 
-    self._dbus = dbusconnection()
+    self._inverterFrames = {}
+    for dtu, data in self._inverterData.items():
+      self._inverterFrames[dtu] = InverterFrame(data)
+
+    # Applied limit reported by the DTU, absolute in W or relative in %
+    self._limitTopics = {}
+    self._limitTopics[0] = {'ch0/active_PowerLimit': 'relative'}
+    self._limitTopics[1] = {'status/limit_absolute': 'absolute', 'status/limit_relative': 'relative'}
+    self._limitApplied = None
+    self._limitAbsolute = False
+    self._limitResends = 0
+    self._limitReportTime = None
+    self._limitReportsIgnored = False
+    self._limitCommand = None   # [limit, time sent] until the DTU reports the limit as applied
+    self._limitTrace = None
+    self._traceResults = {'complete': 0, 'timeout': 0, 'superseded': 0}
+    self._efficiencyCurve = EfficiencyCurve()
+    self._efficiencySeq = 0
+    self._fleet = fleet
+    self._fleetValues = dict.fromkeys(FLEET_PATHS, 0)
+    self._messageCounts = {}
+    self._topicIndex = {}
+
+    self._dbus = dbusConnections.shared()
 
     self._dbusmonitor = dbusmonitor
+    self._mqttPool = mqttPool
+    self._httpPool = httpPool if httpPool is not None else HttpPollerPool()
+    self._http = None
     
     self._init_device_settings(self._deviceinstance)
 
-    self._MQTTName = "{}-{}".format(self._dbusmonitor.get_value('com.victronenergy.system','/Serial'),self._deviceinstance) 
     self._inverterPath = self.settings['/InverterPath']
+    self._eventUpdate = self.settings['/EventUpdate']
+    self._buildTopicIndex()
     
-    self._MQTTconnected = 0
     self._init_MQTT()
+    self._initHttp()
 
     base = 'com.victronenergy'
 
@@ -152,12 +1861,17 @@ class DbusHmInverterService:
       dtu = "OpenDTU"
 
     self._dbusservice = new_service(base, 'vebus', 'DTU', dtu, self._deviceinstance, self._deviceinstance)
+    self._publisher = DbusPublisher(self._dbusservice)
 
     # Init the inverter
     self._initInverter()
+    self.mqttStateChanged()
+    perf.addCollector(self._perfValues)
 
-    # add _inverterLoop function 'timer'
-    gobject.timeout_add(500, self._inverterLoop) 
+    # add inverter loop functions to the scheduler
+    self._scheduler.add('_inverterLoop', 0.5, self._inverterLoop, 0, idle=True)
+    self._scheduler.add('_inverterStateLoop', 20, self._inverterStateLoop, 4)
+    self._scheduler.add('_inverterRefreshLoop', 300, self._inverterRefreshLoop, 4, (deviceinstance % 30) * 10)
   
 
   ###############################
@@ -282,6 +1996,23 @@ class DbusHmInverterService:
       '/PvInverter/Disable':                {'initial': 0, 'textformat': None},
       '/SystemReset':                       {'initial': 0, 'textformat': None},
       '/Enabled':                           {'initial': 0, 'textformat': None},
+
+      '/Mqtt/State':                        {'initial': MQTT_CONNECTING, 'textformat': lambda p, v: MQTT_STATES[v]},
+      '/Mqtt/Connected':                    {'initial': 0, 'textformat': None},
+      '/Mqtt/Reconnects':                   {'initial': 0, 'textformat': None},
+      '/Dtu/Frames':                        {'initial': 0, 'textformat': None},
+      '/Dtu/FramesSuperseded':              {'initial': 0, 'textformat': None},
+      '/Dtu/CommandQueue':                  {'initial': 0, 'textformat': None},
+      '/Dtu/CommandQueueMax':               {'initial': 0, 'textformat': None},
+      '/Dtu/CommandsSent':                  {'initial': 0, 'textformat': None},
+      '/Dtu/CommandsSuperseded':            {'initial': 0, 'textformat': None},
+      '/Dtu/LimitApplied':                  {'initial': None, 'textformat': _w},
+      '/Dtu/LimitLatency':                  {'initial': None, 'textformat': None},
+      '/Dtu/LimitsConfirmed':               {'initial': 0, 'textformat': None},
+      '/Dtu/LimitResends':                  {'initial': 0, 'textformat': None},
+      '/Http/Interval':                     {'initial': None, 'textformat': None},
+      '/Http/Requests':                     {'initial': 0, 'textformat': None},
+      '/Http/Errors':                       {'initial': 0, 'textformat': None},
     }
 
     # add path values to dbus
@@ -347,6 +2078,9 @@ class DbusHmInverterService:
         '/DTU':                           [path + '/DTU', 0, 0, 1],
         '/InverterID':                    [path + '/InverterID', 0, 0, 9],
         '/Enabled':                       [path + '/Enabled', 1, 0, 1],
+        '/EventUpdate':                   [path + '/EventUpdate', 0, 0, 1],
+        '/Transport':                     [path + '/Transport', TRANSPORT_MQTT, 0, 1],
+        '/DtuUrl':                        [path + '/DtuUrl', '', 0, 0],
     }
 
     self.settings = SettingsDevice(self._dbus, SETTINGS, self._setting_changed)
@@ -360,32 +2094,38 @@ class DbusHmInverterService:
 
     elif setting == '/MaxPower':
       self._dbusservice['/Ac/MaxPower'] = newvalue
+      # Relative limit reports may match again
+      self._limitResends = 0
+      self._limitReportsIgnored = False
       
     elif setting == '/InverterPath':
       self._inverterPath = newvalue
-      try:
-        self._MQTTclient.connect(self.settings['/MqttUrl'])
-      except Exception as e:
-        logging.exception("Fehler beim connecten mit Broker")
-        self._MQTTconnected = 0
+      self._buildTopicIndex()
+      self._MQTT.updateRoutes()
     
     elif setting == '/MqttUrl':
-      try:
-        self._MQTTclient.connect(newvalue)
-      except Exception as e:
-        logging.exception("Fehler beim connecten mit Broker")
-        self._MQTTconnected = 0
+      self._mqttPool.release(self._MQTT, self)
+      self._init_MQTT()
+      self.mqttStateChanged()
 
     elif setting == '/DTU':
       if self.settings['/DTU'] == 0:
         self._dbusservice['/Mgmt/Connection'] = "Ahoy"
       else:
         self._dbusservice['/Mgmt/Connection'] = "OpenDTU"
-      try:
-        self._MQTTclient.connect(self.settings['/MqttUrl'])
-      except Exception as e:
-        logging.exception("Fehler beim connecten mit Broker")
-        self._MQTTconnected = 0
+      self._buildTopicIndex()
+      self._MQTT.updateRoutes()
+      self._releaseHttp()
+      self._initHttp()
+
+    elif setting == '/Transport' or setting == '/DtuUrl':
+      self._releaseHttp()
+      self._initHttp()
+      self._buildTopicIndex()
+      self._MQTT.updateRoutes()
+
+    elif setting == '/EventUpdate':
+      self._eventUpdate = newvalue
 
 
   def _checkInverterState(self):
@@ -396,6 +2136,7 @@ class DbusHmInverterService:
         self._dbusservice['/RunState'] = 1
         self._dbusservice['/State'] = 9
         self._inverterOn()
+        self._scheduler.wake()
         return
 
       # Switch off inverter again if it is still running
@@ -419,12 +2160,12 @@ class DbusHmInverterService:
 
   def _inverterOn(self):
     logging.info("Inverter %s on" % (self._deviceinstance))
-    self._MQTTclient.publish(self._inverterControlPath('power'), 1)
+    self._commandQueue().put(self._inverterControlPath('power'), 1, COMMAND_POWER)
     
 
   def _inverterOff(self):
     logging.info("Inverter %s off" % (self._deviceinstance))
-    self._MQTTclient.publish(self._inverterControlPath('power'), 0)
+    self._commandQueue().put(self._inverterControlPath('power'), 0, COMMAND_POWER)
     self._dbusservice['/State'] = 0
 
 
@@ -434,158 +2175,356 @@ class DbusHmInverterService:
     self._dbusservice['/Ac/PowerLimit'] = newLimit
 
 
-  def _inverterSetPower(self, power, force=False):
+  def _inverterSetPower(self, power, force=False, priority=COMMAND_LIMIT):
     newPower      = int(power)
     currentPower  = int(self._dbusservice['/Ac/PowerLimit'] )
 
     if newPower != currentPower or force == True:
-      self._MQTTclient.publish(self._inverterControlPath('limit_nonpersistent_absolute'), newPower)
+      self._limitCommand = [newPower, None]
+      self._commandQueue().put(self._inverterControlPath('limit_nonpersistent_absolute'), newPower, priority, self._limitSent)
+
+
+  def _limitSent(self, now):
+    if self._limitCommand is not None:
+      self._limitCommand[1] = now
+    if self._limitTrace is not None and self._limitTrace.publish is None:
+      self._limitTrace.publish = now
+
+
+  def _limitReported(self, key, value):
+    # Idle callback for a limit report of the DTU
+    if self._limitReportsIgnored:
+      return False
+
+    if self._limitTopics[self.settings['/DTU']].get(key) == 'relative':
+      if self._limitAbsolute:
+        return False
+      value = value * self._dbusservice['/Ac/MaxPower'] / 100
+    else:
+      self._limitAbsolute = True
+
+    self._limitApplied = value
+    self._limitReportTime = self._scheduler.now()
+    self._dbusservice['/Dtu/LimitApplied'] = value
+    self._checkLimitApplied()
+    return False
+
+
+  def _checkLimitApplied(self):
+    limit = self._dbusservice['/Ac/PowerLimit']
+    # Relative limits are reported in whole percent
+    tolerance = max(5, self._dbusservice['/Ac/MaxPower'] * 0.02)
+
+    if abs(self._limitApplied - limit) <= tolerance:
+      self._limitResends = 0
+      if self._limitCommand is not None and self._limitCommand[1] is not None:
+        self._dbusservice['/Dtu/LimitLatency'] = int((self._scheduler.now() - self._limitCommand[1]) * 1000)
+        self._dbusservice['/Dtu/LimitsConfirmed'] += 1
+      self._limitCommand = None
+      if self._limitTrace is not None and self._limitTrace.publish is not None and self._limitTrace.ack is None:
+        self._limitTrace.ack = self._scheduler.now()
+
+    elif self._limitCommand is None and self._dbusservice['/RunState'] >= 1:
+      # The inverter runs with another limit, e.g. after a restart of the inverter
+      self._resendLimit()
+
+
+  def _checkLimitTimeout(self):
+    if self._limitCommand is None or self._limitCommand[1] is None:
+      return
+
+    if self._dbusservice['/RunState'] == 0:
+      # The inverter is off, e.g. at dusk. The limit is sent again when it is switched on.
+      self._limitCommand = None
+      return
+
+    if self._scheduler.now() - self._limitCommand[1] >= LIMIT_ACK_TIMEOUT:
+      if self._limitApplied is None:
+        # The DTU does not report limits
+        self._limitCommand = None
+      else:
+        self._resendLimit()
+
+
+  def _resendLimit(self):
+    # Only resends after a report of another limit count, not those while the inverter does not answer
+    if self._limitCommand is None or self._limitCommand[1] is not None and self._limitReportTime >= self._limitCommand[1]:
+      if self._limitResends >= LIMIT_RESEND_MAX:
+        # The report never matches, e.g. a relative limit of an inverter whose rated power differs from /MaxPower.
+        # Continue like with a DTU that does not report limits.
+        logging.warning("Inverter %s reports limit %s instead of %s, reported limits are ignored" % (self._deviceinstance, self._limitApplied, self._dbusservice['/Ac/PowerLimit']))
+        self._limitReportsIgnored = True
+        self._limitApplied = None
+        self._limitCommand = None
+        return
+      self._limitResends += 1
+
+    logging.info("Inverter %s limit %s not applied, resend" % (self._deviceinstance, self._dbusservice['/Ac/PowerLimit']))
+    self._dbusservice['/Dtu/LimitResends'] += 1
+    self._inverterSetPower(self._dbusservice['/Ac/PowerLimit'], True)
       
 
   def _inverterLoop(self):
-    try:
-      # 0.5s interval
-      self._inverterLoopCounter +=1
+    # 0.5s interval
+    if self._eventUpdate == 0:
       self._inverterUpdate()
-      
-      # 20s interval
-      if self._inverterLoopCounter % 40 == 0:
-        self._checkInverterState()
+    self._checkLimitTimeout()
+    if self._limitTrace is not None and self._scheduler.now() - self._limitTrace.decision >= LIMIT_TRACE_TIMEOUT:
+      self._finishTrace('timeout')
 
-      # 5min interval
-      if self._inverterLoopCounter % 600 == 0:
-        self._inverterLoopCounter = 0
 
-        if self._dbusservice['/RunState'] > 1:
-          self._inverterSetPower(self._dbusservice['/Ac/PowerLimit'], True)
+  def _inverterStateLoop(self):
+    # 20s interval
+    self._checkInverterState()
+    self._updateFrameStats()
 
-    except Exception as e:
-      logging.critical('Error at %s', '_inverterLoop', exc_info=e)
 
-    return True
+  def _inverterRefreshLoop(self):
+    # 5min interval
+    # Only needed if the DTU does not report the applied limit, otherwise differences are resent at once
+    if self._dbusservice['/RunState'] > 1 and self._limitApplied is None:
+      self._inverterSetPower(self._dbusservice['/Ac/PowerLimit'], True, COMMAND_REFRESH)
 
 
-  def _inverterUpdate(self):
-    try:
+  def _inverterValues(self):
+    pvinverter_phase = 'L' + str(self.settings['/Phase'])        
+    data = self._inverterFrames[self.settings['/DTU']].read()
 
-      pvinverter_phase = 'L' + str(self.settings['/Phase'])        
+    if self.settings['/DTU'] == 0:
+      # Ahoy
+      powerAC     = data['ch0/P_AC']
+      voltageAC   = data['ch0/U_AC']
+      currentAC   = data['ch0/I_AC']
+      frequency   = data['ch0/Freq']
+      yieldTotal  = data['ch0/YieldTotal']
+      efficiency  = data['ch0/Efficiency']
+      volatageDC  = data['ch1/U_DC']
+      powerDC     = data['ch0/P_DC']
+      temperature = data['ch0/Temp']
+      currentDC = 0
+      for i in range(1, 5):
+        currentDC -= data[f'ch{i}/I_DC']
+    else:
+      # OpenDTU
+      powerAC     = data['0/power']
+      voltageAC   = data['0/voltage']
+      currentAC   = data['0/current']
+      frequency   = data['0/frequency']
+      yieldTotal  = data['0/yieldtotal']
+      efficiency  = data['0/efficiency']
+      volatageDC  = data['1/voltage']
+      powerDC     = data['0/powerdc']
+      temperature = data['0/temperature']
+      currentDC = 0
+      for i in range(1, 5):
+        currentDC -= data[f'{i}/current']
+
+    values = {}
+    for phase in ['L1', 'L2', 'L3']:
+      pre1 = '/Ac/ActiveIn/' + phase
+      pre2 = '/Ac/Inverter/' + phase
+
+      if phase == pvinverter_phase:
+        values[pre1 + '/V'] = voltageAC
+        values[pre2 + '/I'] = currentAC
+        values[pre2 + '/P'] = powerAC
+        values[pre1 + '/F'] = frequency
 
-      if self.settings['/DTU'] == 0:
-        # Ahoy
-        powerAC     = self._inverterData[0]['ch0/P_AC']
-        voltageAC   = self._inverterData[0]['ch0/U_AC']
-        currentAC   = self._inverterData[0]['ch0/I_AC']
-        frequency   = self._inverterData[0]['ch0/Freq']
-        yieldTotal  = self._inverterData[0]['ch0/YieldTotal']
-        efficiency  = self._inverterData[0]['ch0/Efficiency']
-        volatageDC  = self._inverterData[0]['ch1/U_DC']
-        powerDC     = self._inverterData[0]['ch0/P_DC']
-        temperature = self._inverterData[0]['ch0/Temp']
-        currentDC = 0
-        for i in range(1, 5):
-          currentDC -= self._inverterData[0][f'ch{i}/I_DC']
       else:
-        # OpenDTU
-        powerAC     = self._inverterData[1]['0/power']
-        voltageAC   = self._inverterData[1]['0/voltage']
-        currentAC   = self._inverterData[1]['0/current']
-        frequency   = self._inverterData[1]['0/frequency']
-        yieldTotal  = self._inverterData[1]['0/yieldtotal']
-        efficiency  = self._inverterData[1]['0/efficiency']
-        volatageDC  = self._inverterData[1]['1/voltage']
-        powerDC     = self._inverterData[1]['0/powerdc']
-        temperature = self._inverterData[1]['0/temperature']
-        currentDC = 0
-        for i in range(1, 5):
-          currentDC -= self._inverterData[1][f'{i}/current']
+        values[pre1 + '/V'] = 0
+        values[pre2 + '/I'] = 0
+        values[pre2 + '/P'] = 0
+        values[pre1 + '/F'] = 0
 
-      #send data to DBus
-      for phase in ['L1', 'L2', 'L3']:
-        pre1 = '/Ac/ActiveIn/' + phase
-        pre2 = '/Ac/Inverter/' + phase
+    values['/Ac/Power'] = powerAC
+    values['/Ac/Energy/Forward'] = yieldTotal
+    values['/Ac/Efficiency'] = efficiency
 
-        if phase == pvinverter_phase:
-          self._dbusservice[pre1 + '/V'] = voltageAC
-          self._dbusservice[pre2 + '/I'] = currentAC
-          self._dbusservice[pre2 + '/P'] = powerAC
-          self._dbusservice[pre1 + '/F'] = frequency
+    values['/Dc/1/Current'] = currentDC
+    values['/Dc/0/Voltage'] = volatageDC
+    values['/Dc/1/Power'] = powerDC
 
-        else:
-          self._dbusservice[pre1 + '/V'] = 0
-          self._dbusservice[pre2 + '/I'] = 0
-          self._dbusservice[pre2 + '/P'] = 0
-          self._dbusservice[pre1 + '/F'] = 0
+    values['/Temperature'] = temperature
 
-      self._dbusservice['/Ac/Power'] = powerAC
-      self._dbusservice['/Ac/Energy/Forward'] = yieldTotal
-      self._dbusservice['/Ac/Efficiency'] = efficiency
+    return values
 
-      self._dbusservice['/Dc/1/Current'] = currentDC
-      self._dbusservice['/Dc/0/Voltage'] = volatageDC
-      self._dbusservice['/Dc/1/Power'] = powerDC
 
-      self._dbusservice['/Temperature'] = temperature
+  def _inverterUpdate(self):
+    try:
+      #send data to DBus
+      seq = self._inverterFrames[self.settings['/DTU']].getSeq()
+      values = self._inverterValues()
+      self._publisher.publish(values)
+
+      # push the changes into the fleet totals
+      if self._fleet is not None:
+        for path in FLEET_PATHS:
+          delta = values[path] - self._fleetValues[path]
+          if delta != 0:
+            self._fleetValues[path] = values[path]
+            self._fleet.add(path, delta)
+
+      # learn the efficiency once per DTU frame
+      if seq != self._efficiencySeq:
+        self._efficiencySeq = seq
+        if self._dbusservice['/Ac/MaxPower'] > 0:
+          self._efficiencyCurve.add(values['/Ac/Power'] / self._dbusservice['/Ac/MaxPower'], values['/Ac/Power'], values['/Dc/1/Power'])
+        self._checkTraceResponse(values['/Ac/Power'])
 
     except Exception as e:
+      perf.count('exceptions_total', (('at', '_inverterUpdate'),))
       logging.critical('Error at %s', '_update', exc_info=e)
 
     return True
 
 
+  def _checkTraceResponse(self, power):
+    # The power follows the new limit once it covered 90% of the step, limits
+    # above the available PV power end with a timeout
+    trace = self._limitTrace
+    if trace is None or trace.publish is None:
+      return
+    step = trace.limit - trace.power
+    if abs(step) <= max(5, self._dbusservice['/Ac/MaxPower'] * 0.02) or (power - trace.power) / step >= 0.9:
+      trace.response = self._scheduler.now()
+      self._finishTrace('complete')
+
+
+  def _finishTrace(self, result):
+    trace = self._limitTrace
+    self._limitTrace = None
+    self._traceResults[result] += 1
+    if result == 'superseded':
+      return
+
+    latencies = trace.latencies()
+    for stage, latency in latencies.items():
+      if latency is not None:
+        _LIMIT_LATENCY[stage].observe(latency)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug("Limit trace %s inverter %s %s: %s" % (trace.id, self._deviceinstance, result,
+        ', '.join('%s %s' % (stage, 'n/a' if latency is None else '%.3fs' % (latency)) for stage, latency in latencies.items())))
+
+
+  def _inverterEventUpdate(self):
+    # Idle callback scheduled by _on_MQTT_message, coalesces all frames completed since the last run
+    self._updateScheduled = False
+    self._inverterUpdate()
+    return False
+
+
+  def _updateFrameStats(self):
+    frames = 0
+    superseded = 0
+    for frame in self._inverterFrames.values():
+      frames += frame.getSeq()
+      superseded += frame.superseded
+
+    self._dbusservice['/Dtu/Frames'] = frames
+    self._dbusservice['/Dtu/FramesSuperseded'] = superseded
+
+    queue = self._commandQueue()
+    self._dbusservice['/Dtu/CommandQueue'] = queue.getDepth()
+    self._dbusservice['/Dtu/CommandQueueMax'] = queue.maxDepth
+    self._dbusservice['/Dtu/CommandsSent'] = queue.sent
+    self._dbusservice['/Dtu/CommandsSuperseded'] = queue.superseded
+
+    if self._http is not None:
+      self._dbusservice['/Http/Interval'] = round(self._http.interval, 1)
+      self._dbusservice['/Http/Requests'] = self._http.requests
+      self._dbusservice['/Http/Errors'] = self._http.errors
+
+
+  def _perfValues(self):
+    # Counters of this inverter for the performance export
+    inverter = ('inverter', self._deviceinstance)
+    counts = dict(self._messageCounts)
+    for frame, key, count in list(self._topicIndex.values()):
+      counts[key] = counts.get(key, 0) + count
+    values = [('mqtt_messages_total', (inverter, ('topic', key)), count) for key, count in counts.items()]
+    frames = superseded = 0
+    for frame in self._inverterFrames.values():
+      frames += frame.getSeq()
+      superseded += frame.superseded
+    values.append(('dtu_frames_total', (inverter,), frames))
+    values.append(('dtu_frames_superseded_total', (inverter,), superseded))
+    values.append(('limits_confirmed_total', (inverter,), self._dbusservice['/Dtu/LimitsConfirmed']))
+    values.append(('limit_resends_total', (inverter,), self._dbusservice['/Dtu/LimitResends']))
+    values.append(('dbus_items_published_total', (inverter,), self._publisher.itemsPublished))
+    for result, count in self._traceResults.items():
+      values.append(('limit_traces_total', (inverter, ('result', result)), count))
+    return values
+
+
   def _init_MQTT(self):
-    self._MQTTclient = mqtt.Client(self._MQTTName) # create new instance
-    self._MQTTclient.on_disconnect = self._on_MQTT_disconnect
-    self._MQTTclient.on_connect = self._on_MQTT_connect
-    self._MQTTclient.on_message = self._on_MQTT_message
-    try:
-      self._MQTTclient.connect(self.settings['/MqttUrl'])  # connect to broker
-      self._MQTTclient.loop_start()
-    except Exception as e:
-      logging.exception("Fehler beim connecten mit Broker")
-      self._MQTTconnected = 0
+    self._MQTT = self._mqttPool.acquire(self.settings['/MqttUrl'], self)
 
 
-  def _on_MQTT_disconnect(self, client, userdata, rc):
-    print("Client Got Disconnected")
-    if rc != 0:
-        print('Unexpected MQTT disconnection. Will auto-reconnect')
+  def _initHttp(self):
+    if self.settings['/Transport'] == TRANSPORT_HTTP and self.settings['/DtuUrl'] != '':
+      self._http = self._httpPool.acquire(self.settings['/DtuUrl'], self.settings['/DTU'], self)
 
-    else:
-        print('rc value:' + str(rc))
 
-    try:
-        print("Trying to Reconnect")
-        client.connect(self.settings['/MqttUrl'])
-        self._MQTTconnected = 1
-    except Exception as e:
-        logging.exception("Fehler beim reconnecten mit Broker")
-        print("Error in Retrying to Connect with Broker")
-        self._MQTTconnected = 0
-        print(e)
+  def _releaseHttp(self):
+    if self._http is not None:
+      self._httpPool.release(self._http, self)
+      self._http = None
 
 
-  def _on_MQTT_connect(self, client, userdata, flags, rc):
-    if rc == 0:
-        self._MQTTconnected = 1
+  def _commandQueue(self):
+    # Inverters with the same topic prefix on a broker share one DTU
+    return self._MQTT.commandQueue('/'.join(self._inverterPath.split('/')[:-1]))
 
-        for k,v in self._inverterData[self.settings['/DTU']].items():
-          client.subscribe(f'{self._inverterPath}/{k}')
 
-    else:
-        print("Failed to connect, return code %d\n", rc)
+  def _buildTopicIndex(self):
+    # Keep the message counts of the topics being replaced
+    for frame, k, count in self._topicIndex.values():
+      self._messageCounts[k] = self._messageCounts.get(k, 0) + count
+
+    self._limitApplied = None
+    self._limitAbsolute = False
+    self._limitResends = 0
+    self._limitReportsIgnored = False
+    self._topicIndex = {}
+    if self.settings['/Transport'] == TRANSPORT_HTTP:
+      # The values are polled, MQTT is only used for commands
+      return
+
+    # Map the full MQTT topic of every inverter value to [frame, key, message count], so a message costs one lookup
+    frame = self._inverterFrames[self.settings['/DTU']]
+    self._topicIndex = {f'{self._inverterPath}/{k}': [frame, k, 0] for k in self._inverterData[self.settings['/DTU']]}
+    # Limit reports are not part of a frame
+    for k in self._limitTopics[self.settings['/DTU']]:
+      self._topicIndex[f'{self._inverterPath}/{k}'] = [None, k, 0]
 
 
   def _on_MQTT_message(self, client, userdata, msg):
-      try:       
-        for k,v in self._inverterData[self.settings['/DTU']].items():
-          if msg.topic == f'{self._inverterPath}/{k}':
-            self._inverterData[self.settings['/DTU']][k] = float(msg.payload)
-            return
+      try:
+        entry = self._topicIndex.get(msg.topic)
+        if entry is None:
+          return
+        entry[2] += 1
+
+        if entry[0] is None:
+          gobject.idle_add(self._limitReported, entry[1], float(msg.payload))
+
+        elif entry[0].update(entry[1], float(msg.payload)):
+          self._frameCompleted()
 
       except Exception as e:
+          perf.count('exceptions_total', (('at', '_on_MQTT_message'),))
           logging.critical('Error at %s', '_update', exc_info=e)
 
 
+  def _frameCompleted(self):
+    # Called by the paho or HTTP poller thread
+    if self._scheduler.idle:
+      gobject.idle_add(self._scheduler.wake)
+    if self._eventUpdate == 1 and self._updateScheduled == False:
+      self._updateScheduled = True
+      gobject.idle_add(self._inverterEventUpdate)
+
+
   def _inverterControlPath(self, setting):
     if self.settings['/DTU'] == 0:
       # Ahoy
@@ -661,10 +2600,73 @@ class DbusHmInverterService:
     return True
 
 
-  def setPowerLimit(self,newLimit):
+  def publishDbusservice(self,values):
+    return self._publisher.publish(values)
+
+
+  def getPublisher(self):
+    return self._publisher
+
+
+  def getEfficiencyCurve(self):
+    return self._efficiencyCurve
+
+
+  def getMessageCount(self):
+    return sum(self._messageCounts.values()) + sum(entry[2] for entry in list(self._topicIndex.values()))
+
+
+  def getFrameSeq(self):
+    return self._inverterFrames[self.settings['/DTU']].getSeq()
+
+
+  def getHttpId(self):
+    # Ahoy addresses inverters by ID, OpenDTU by serial, the last part of the MQTT path
+    if self.settings['/DTU'] == 0:
+      return int(self.settings['/InverterID'])
+    else:
+      return self._inverterPath.split('/')[-1]
+
+
+  def httpFrame(self, values, limitKey, limit):
+    # Called by the HTTP poller thread with all values of one DTU update
+    try:
+      frame = self._inverterFrames[self.settings['/DTU']]
+      data = self._inverterData[self.settings['/DTU']]
+      if frame.replace({k: float(v) for k, v in values.items() if k in data}):
+        self._frameCompleted()
+      if limit is not None:
+        gobject.idle_add(self._limitReported, limitKey, float(limit))
+
+    except Exception as e:
+      perf.count('exceptions_total', (('at', 'httpFrame'),))
+      logging.critical('Error at %s', 'httpFrame', exc_info=e)
+
+
+  def mqttStateChanged(self):
+    self._dbusservice['/Mqtt/State'] = self._MQTT.state
+    self._dbusservice['/Mqtt/Connected'] = 1 if self._MQTT.state == MQTT_CONNECTED else 0
+    self._dbusservice['/Mqtt/Reconnects'] = max(0, self._MQTT.connects - 1)
+
+
+  def getFleetValue(self, path):
+    # Value of this inverter contained in the fleet totals
+    return self._fleetValues[path]
+
+
+  def setPowerLimit(self,newLimit,trace=None):
+    # trace: (trace id, grid sample time, decision time) of the control action
     newLimit = int(min(newLimit, self._dbusservice['/Ac/MaxPower']))
     newLimit = int(max(newLimit, self._dbusservice['/Ac/MaxPower'] * 0.05))
     logging.debug("Inverter %s limit: %s" % (self._deviceinstance,newLimit))
+
+    # Trace only limits sent to the DTU. The trace is created first, as the
+    # command queue publishes at once if the spacing allows it.
+    if trace is not None and self._dbusservice['/RunState'] >= 1 and newLimit != int(self._dbusservice['/Ac/PowerLimit']):
+      if self._limitTrace is not None:
+        self._finishTrace('superseded')
+      self._limitTrace = LimitTrace(trace[0], trace[1], trace[2], newLimit, self._dbusservice['/Ac/Power'])
+
     self._inverterSetLimit(newLimit)
     
     return self._dbusservice['/Ac/PowerLimit']
@@ -681,33 +2683,163 @@ class DbusHmInverterService:
 #                                                                              #
 ################################################################################
 
-class hmControl:
+CONTROL_INTERVAL = 0.5  # s, period of the control loop while not idle
+IDLE_QUIET_TIME = 120   # s without a DTU update until the loops slow down
+PERF_FILE_INTERVAL = 300   # s between two writes of the Prometheus textfile
+
+# Duration histograms published as /Perf/<name>/Mean, P95 and Max in ms
+_PERF_HISTOGRAMS = {
+  'TimerLateness':  ('timer_lateness_seconds', ()),
+  'InverterLoop':   ('task_duration_seconds', (('task', '_inverterLoop'),)),
+  'ControlLoop':    ('task_duration_seconds', (('task', '_controlLoop'),)),
+  'CalcLimit':      ('calc_limit_seconds', ()),
+  'SetLimit':       ('set_limit_seconds', ()),
+}
+# Stage latencies of the limit traces, /Perf/Latency/<stage>/...
+for stage in LIMIT_TRACE_STAGES:
+  _PERF_HISTOGRAMS['Latency/' + stage.capitalize()] = ('limit_latency_seconds', (('stage', stage),))
+
+
+_GRID_PHASES = {
+  '/Ac/Grid/L1/Power': 1,
+  '/Ac/Grid/L2/Power': 2,
+  '/Ac/Grid/L3/Power': 3,
+}
+
+_POWER_METER_PATHS = {
+  '/Ac/Power',
+  '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power',
+  '/Ac/L1/Current', '/Ac/L2/Current', '/Ac/L3/Current',
+}
+
+# (service, path): (slot, phase index, value used for None)
+_SNAPSHOT_PATHS = {
+  ('com.victronenergy.settings', '/Settings/CGwacs/BatteryLife/State'): ('batteryLifeState', None, None),
+  ('com.victronenergy.system', '/Dc/Battery/Soc'): ('soc', None, None),
+  ('com.victronenergy.system', '/Dc/Pv/Power'): ('pvPower', None, 0),
+  ('com.victronenergy.system', '/Ac/Grid/L1/Power'): ('gridPower', 0, 0),
+  ('com.victronenergy.system', '/Ac/Grid/L2/Power'): ('gridPower', 1, 0),
+  ('com.victronenergy.system', '/Ac/Grid/L3/Power'): ('gridPower', 2, 0),
+  ('com.victronenergy.system', '/Ac/Consumption/L1/Power'): ('consumption', 0, 0),
+  ('com.victronenergy.system', '/Ac/Consumption/L2/Power'): ('consumption', 1, 0),
+  ('com.victronenergy.system', '/Ac/Consumption/L3/Power'): ('consumption', 2, 0),
+}
+
+
+class SystemSnapshot:
+  # Monitored system values, kept up to date by the DbusMonitor value change
+  # callback. Power values that are not available are 0, the battery values None.
+  __slots__ = ('batteryLifeState', 'soc', 'pvPower', 'gridPower', 'consumption')
+
   def __init__(self):
+    self.batteryLifeState = None
+    self.soc = None
+    self.pvPower = 0
+    self.gridPower = [0, 0, 0]
+    self.consumption = [0, 0, 0]
+
+
+  def update(self, service, path, value):
+    # Returns False for paths that are not part of the snapshot
+    slot = _SNAPSHOT_PATHS.get((service, path))
+    if slot is None:
+      return False
+
+    name, index, default = slot
+    if value is None:
+      value = default
+    if index is None:
+      setattr(self, name, value)
+    else:
+      getattr(self, name)[index] = value
+    return True
+
+
+  def load(self, dbusmonitor):
+    for (service, path) in _SNAPSHOT_PATHS:
+      self.update(service, path, dbusmonitor.get_value(service, path))
+
+
+  def copy(self):
+    snapshot = SystemSnapshot()
+    snapshot.batteryLifeState = self.batteryLifeState
+    snapshot.soc = self.soc
+    snapshot.pvPower = self.pvPower
+    snapshot.gridPower = list(self.gridPower)
+    snapshot.consumption = list(self.consumption)
+    return snapshot
+
+
+class hmControl:
+  def __init__(self, scheduler):
     self.settings = None
-    self._controlLoopCounter = 0
-    self._pvPowerAvg =  [0] * 20 * 15
+    self._scheduler = scheduler
+    self._pvPowerAvg = RingBuffer(20 * 15)
     self._gridPower = 0
-    self._gridPowerAvg =  [0] * 6
+    self._gridPowerAvg = RingBuffer(6)
+    self._gridPhasePower = [0] * 3
+    self._gridPhasePowerAvg = [RingBuffer(6) for i in range(3)]
+    self._inverterPhasePower = [0] * 3
     self._loadPower = 0
-    self._loadPowerHistory =  [600] * 30
-    self._loadPowerMin = [600]*40
-    self._powerLimitCounter = 10
-    self._dbus = dbusconnection()
+    self._loadPowerHistory = SlidingMin(30, initial=600)
+    # 15s load minima of up to 4 hours
+    self._loadPowerMin = SlidingMin(40, capacity=4 * 240, initial=600)
+    self._loadPowerQuantile = SlidingQuantile(40, capacity=4 * 240, initial=600)
+    self._lastLimitTime = self._scheduler.now() - 5
+    self._lastFastLimitTime = 0
+    self._lastPhaseLimitTime = [self._scheduler.now() - 5] * 3
+    self._lastFastPhaseLimitTime = [0] * 3
+    self._gridSampleTime = [self._scheduler.now()] * 3
+    self._lastSystemSample = self._scheduler.now()
+    self._traceId = 0
+    self._recorder = None
+    self._profiler = None
+    self._dbus = dbusConnections.shared()
     self._powerMeterService = None
+    self._powerMeterValues = {}
+    self._powerMeterChanged = False
+    self._fleet = FleetTotals()
+    self._frameSeq = 0
+    self._lastFrameTime = self._scheduler.now()
+    self._calcLimitTime = perf.histogram('calc_limit_seconds')
+    self._setLimitTime = perf.histogram('set_limit_seconds')
+    self._perfFileTask = None
+    self._itemsPublished = 0
+    self._lastPerfTime = self._scheduler.now()
 
     self._devices = []
+    self._systemValues = SystemSnapshot()
     self._initDbusMonitor()
+    self._systemValues.load(self._dbusmonitor)
+    self._system = self._systemValues.copy()
+    self._mqttPool = MqttConnectionPool(self._dbusmonitor.get_value('com.victronenergy.system','/Serial'), self._scheduler)
+    self._httpPool = HttpPollerPool()
     self._initDeviceSettings()
+    self._mqttPool.setCommandSpacing(self.settings['/CommandSpacing'])
+    self._scheduler.setIdlePeriod(self.settings['/IdleInterval'])
+    perf.addCollector(self._perfValues)
+    self._loadPowerMin.setWindow(self.settings['/BaseLoadPeriod'] * 4)
+    self._loadPowerQuantile.setWindow(self.settings['/BaseLoadPeriod'] * 4)
 
     self._dbusservice = new_service('com.victronenergy', 'hm', 'hmControl', 'hmControl', 0, 0)
+    self._publisher = DbusPublisher(self._dbusservice)
     self._initDbusservice()
 
     self._refreshAcloads()
 
     self._checkState()
 
-    # add _controlLoop function 'timer'
-    gobject.timeout_add(500, self._controlLoop)
+    # add control loop functions to the scheduler
+    self._scheduler.add('_controlLoop', CONTROL_INTERVAL, self._controlLoop, 1, idle=True)
+    self._scheduler.add('_samplePvPower', 5, self._samplePvPower, 2)
+    self._scheduler.add('_sampleLoadPower', 15, self._sampleLoadPower, 2)
+    self._scheduler.add('_updateAverages', 60, self._updateAverages, 2)
+    self._scheduler.add('_recomputeTotals', 60, self._recomputeTotals, 2)
+    self._scheduler.add('_calcStartLimit', 60, self._calcStartLimit, 3)
+    self._scheduler.add('_calcMaxPowerLimit', 30, self._calcMaxPowerLimit, 3)
+    self._scheduler.add('_calcBaseLoadLimit', 15, self._calcBaseLoadLimit, 3)
+    self._scheduler.add('_checkState', 300, self._checkState, 4)
+    self._setPerfFile(self.settings['/PerfFile'])
 
 
   ###############################
@@ -721,13 +2853,44 @@ class hmControl:
       '/StartLimit':            {'initial': 0, 'textformat': None},
       '/State':                 {'initial': 0, 'textformat': None},
       '/PvAvgPower':            {'initial': 0, 'textformat': _w},
+      '/BaseLoad':              {'initial': 0, 'textformat': _w},
+      '/FastLimitCount':        {'initial': 0, 'textformat': None},
       '/Ac/Power':              {'initial': 0, 'textformat': _a},
+      '/Dbus/ItemsPublished':   {'initial': 0, 'textformat': None},
+      '/Dbus/ItemsSuppressed':  {'initial': 0, 'textformat': None},
+      '/Dbus/SignalsSaved':     {'initial': 0, 'textformat': None},
+      '/Dbus/Connections':      {'initial': 0, 'textformat': None},
+      '/Dbus/ConnectTime':      {'initial': 0, 'textformat': None},
+      '/Scheduler/MaxLateness': {'initial': 0, 'textformat': None},
+      '/Scheduler/Skipped':     {'initial': 0, 'textformat': None},
+      '/Scheduler/Idle':        {'initial': 0, 'textformat': None},
+      '/Scheduler/Interval':    {'initial': 0.5, 'textformat': None},
+      '/Trace/Record':          {'initial': 0, 'textformat': None},
+      '/Trace/File':            {'initial': '', 'textformat': None},
+      '/Trace/Records':         {'initial': 0, 'textformat': None},
+      '/Profile/Duration':      {'initial': 0, 'textformat': None},
+      '/Profile/File':          {'initial': '', 'textformat': None},
+      '/Profile/Samples':       {'initial': 0, 'textformat': None},
+      '/Phase/L1/Target':       {'initial': 0, 'textformat': _w},
+      '/Phase/L1/Error':        {'initial': 0, 'textformat': _w},
+      '/Phase/L2/Target':       {'initial': 0, 'textformat': _w},
+      '/Phase/L2/Error':        {'initial': 0, 'textformat': _w},
+      '/Phase/L3/Target':       {'initial': 0, 'textformat': _w},
+      '/Phase/L3/Error':        {'initial': 0, 'textformat': _w},
+      '/Perf/Messages':         {'initial': 0, 'textformat': None},
+      '/Perf/Commands':         {'initial': 0, 'textformat': None},
+      '/Perf/Exceptions':       {'initial': 0, 'textformat': None},
+      '/Perf/DbusWrites':       {'initial': 0, 'textformat': None},
       #'/Debug0':                {'initial': 0, 'textformat': None},
       #'/Debug1':                {'initial': 0, 'textformat': None},
       #'/Debug2':                {'initial': 50, 'textformat': None},
       #'/Debug3':                {'initial': 50, 'textformat': None},
     }
 
+    for name in _PERF_HISTOGRAMS:
+      for stat in ('Mean', 'P95', 'Max'):
+        paths[f'/Perf/{name}/{stat}'] = {'initial': 0, 'textformat': None}
+
     # add path values to dbus
     for path, settings in paths.items():
       self._dbusservice.add_path(
@@ -741,31 +2904,121 @@ class hmControl:
 
   def _handleChangedValue(self, path, value):
     logging.info("dbus_value_changed: %s %s" % (path, value,))
+
+    if path == '/Trace/Record':
+      if value == 1:
+        # /Trace/Record stays 0 if the file can not be created
+        return self._startTrace()
+      else:
+        self._stopTrace()
+
+    elif path == '/Profile/Duration':
+      if value > 0:
+        self._startProfile(value)
+      elif self._profiler != None:
+        self._profiler.stop()
+
     return True
 
 
-  def _controlLoop(self):
-    try:
-      # 0.5s interval
-      self._controlLoopCounter +=1
-      self._powerLimitCounter +=1
-      
-      self._updateVebusTotal()
-      self._getSystemPower()
-      self._calcLimit()
-
-      # 5min interval
-      if self._controlLoopCounter % 600 == 0:
-        self._controlLoopCounter = 0
-        self._checkState()
-        
+  def _startTrace(self):
+    if self._recorder != None:
+      return True
 
+    filename = "%s/trace-%s.hmtr" % (os.path.dirname(os.path.realpath(__file__)), time.strftime('%Y%m%d-%H%M%S'))
+    recorder = None
+    try:
+      recorder = TraceRecorder(filename, self._scheduler.now)
+      for path, channel in _TRACE_PATHS.items():
+        recorder.record(channel, self._dbusmonitor.get_value('com.victronenergy.system', path))
+      recorder.record(TRACE_LIMIT_MODE, self.settings['/LimitMode'])
+      for index, device in enumerate(self._devices[:TRACE_MAX_INVERTERS]):
+        recorder.record(TRACE_INVERTER_PHASE + index, device.settings['/Phase'])
+        recorder.record(TRACE_INVERTER_MAXPOWER + index, device.MaxPower)
+      recorder.flush()
     except Exception as e:
-      logging.critical('Error at %s', '_inverterLoop', exc_info=e)
+      logging.warning("Trace recording to %s failed: %s" % (filename, e))
+      if recorder is not None:
+        try:
+          recorder.close()
+        except Exception:
+          pass
+      self._dbusservice['/Trace/Record'] = 0
+      return False
 
+    self._recorder = recorder
+    self._traceTask = self._scheduler.add('_flushTrace', 60, self._flushTrace, 5)
+    self._dbusservice['/Trace/File'] = filename
+    logging.info("Trace recording to %s" % (filename))
     return True
 
 
+  def _stopTrace(self):
+    if self._recorder == None:
+      return
+
+    self._scheduler.remove(self._traceTask)
+    self._recorder.close()
+    logging.info("Trace recording stopped, %s records" % (self._recorder.records))
+    self._recorder = None
+
+
+  def _flushTrace(self):
+    self._recorder.flush()
+    self._dbusservice['/Trace/Records'] = self._recorder.records
+
+
+  def _startProfile(self, duration):
+    if self._profiler != None:
+      return
+
+    filename = "%s/profile-%s.folded" % (os.path.dirname(os.path.realpath(__file__)), time.strftime('%Y%m%d-%H%M%S'))
+    self._profiler = SamplingProfiler(filename, duration, self._profileDone)
+    self._dbusservice['/Profile/File'] = filename
+    logging.info("Profiling for %ss to %s" % (duration, filename))
+
+
+  def _profileDone(self, profiler):
+    self._profiler = None
+    self._dbusservice['/Profile/Duration'] = 0
+    self._dbusservice['/Profile/Samples'] = profiler.samples
+    logging.info("Profile written to %s, %s samples" % (profiler.filename, profiler.samples))
+    return False
+
+
+  def _controlLoop(self):
+    # 0.5s interval
+    # All tasks of this tick see the same system values
+    self._system = self._systemValues.copy()
+    self._updateVebusTotal()
+    self._getSystemPower()
+    start = time.perf_counter()
+    self._calcLimit()
+    self._calcLimitTime.samples.append(time.perf_counter() - start)
+    self._checkIdle()
+
+
+  def _checkIdle(self):
+    # Slow down the loops while no inverter can change its power: control off,
+    # all inverters off or no update from any DTU for IDLE_QUIET_TIME
+    now = self._scheduler.now()
+    seq = 0
+    running = False
+    for device in self._devices:
+      seq += device.getFrameSeq()
+      running = running or device.getDbusservice('/RunState') != 0
+    if seq != self._frameSeq:
+      self._frameSeq = seq
+      self._lastFrameTime = now
+
+    idle = self._dbusservice['/State'] == 0 or running == False or now - self._lastFrameTime >= IDLE_QUIET_TIME
+    self._scheduler.setIdle(idle)
+    self._publisher.publish({
+      '/Scheduler/Idle': 1 if idle else 0,
+      '/Scheduler/Interval': max(CONTROL_INTERVAL, self.settings['/IdleInterval']) if idle else CONTROL_INTERVAL,
+    })
+
+
   def _initDbusMonitor(self):
     dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
     dbus_tree = {
@@ -791,6 +3044,9 @@ class hmControl:
         '/Ac/L1/Power': dummy,
         '/Ac/L2/Power': dummy,
         '/Ac/L3/Power': dummy,
+        '/Ac/L1/Current': dummy,
+        '/Ac/L2/Current': dummy,
+        '/Ac/L3/Current': dummy,
         '/CustomName': dummy,
         '/ProductName': dummy,
         '/DeviceInstance': dummy,
@@ -804,6 +3060,10 @@ class hmControl:
     for device in self._devices:
       device._dbusValueChanged(dbusServiceName, dbusPath, options, changes, deviceInstance)
 
+    if self._systemValues.update(dbusServiceName, dbusPath, changes['Value']):
+      # Values for the event driven checks below
+      self._system = self._systemValues.copy()
+
     if dbusPath in {'/Dc/Battery/Soc','/Settings/CGwacs/BatteryLife/State','/Hub','/PvPowerLimiterActive'}:
       logging.info("dbus_value_changed: %s %s %s" % (dbusServiceName, dbusPath, changes['Value']))
 
@@ -819,11 +3079,24 @@ class hmControl:
       for device in self._devices:
         logging.debug("Device: %s  Master: %s" % (device.getDbusservice('/DeviceInstance'), device.IsMaster))
 
+    elif dbusPath in _GRID_PHASES and dbusServiceName == 'com.victronenergy.system':
+      self._gridSampleTime[_GRID_PHASES[dbusPath] - 1] = self._scheduler.now()
+      self._calcFastLimit(_GRID_PHASES[dbusPath])
+
+    elif dbusPath in _POWER_METER_PATHS and dbusServiceName == self._powerMeterService:
+      self._powerMeterValues[dbusPath] = changes['Value']
+      self._powerMeterChanged = True
+
+    if self._recorder != None and dbusPath in _TRACE_PATHS and dbusServiceName == 'com.victronenergy.system':
+      self._recorder.record(_TRACE_PATHS[dbusPath], changes['Value'])
+
     return
 
       
   def _dbusDeviceAdded(self,dbusservicename, instance):
     logging.info("dbus device added: %s %s " % (dbusservicename, instance))
+    if dbusservicename in ('com.victronenergy.system', 'com.victronenergy.settings'):
+      self._systemValues.load(self._dbusmonitor)
     self._refreshAcloads()
     return
 
@@ -844,13 +3117,20 @@ class hmControl:
         '/StartLimit':                    [path + '/StartLimit', 0, 0, 1],
         '/StartLimitMin':                 [path + '/StartLimitMin', 50, 50, 500],
         '/StartLimitMax':                 [path + '/StartLimitMax', 500, 100, 2000],
-        '/LimitMode':                     [path + '/LimitMode', 0, 0, 2],
+        '/LimitMode':                     [path + '/LimitMode', 0, 0, 3],
+        '/LimitAllocation':               [path + '/LimitAllocation', 0, 0, 3],
         '/PowerMeterInstance':            [path + '/PowerMeterInstance', 0, 0, 0],
         '/GridTargetDevMin':              [path + '/GridTargetDevMin', 25, 5, 100],
         '/GridTargetDevMax':              [path + '/GridTargetDevMax', 25, 5, 100],
         '/GridTargetPower':               [path + '/GridTargetPower', 25, -100, 200],
         '/GridTargetInterval':            [path + '/GridTargetInterval', 15, 3, 60],
-        '/BaseLoadPeriod':                [path + '/BaseLoadPeriod', 0.5, 0.5, 10],
+        '/BaseLoadPeriod':                [path + '/BaseLoadPeriod', 0.5, 0.5, 240],
+        '/BaseLoadQuantile':              [path + '/BaseLoadQuantile', 0, 0, 25],
+        '/FastLimitThreshold':            [path + '/FastLimitThreshold', 0, 0, 1000],
+        '/FastLimitInterval':             [path + '/FastLimitInterval', 1, 0.5, 10],
+        '/CommandSpacing':                [path + '/CommandSpacing', 0.5, 0, 5],
+        '/IdleInterval':                  [path + '/IdleInterval', 5, 0.5, 60],
+        '/PerfFile':                      [path + '/PerfFile', '', 0, 0],
         '/Settings/SystemSetup/AcInput1': ['/Settings/SystemSetup/AcInput1', 1, 0, 1],
         '/Settings/SystemSetup/AcInput2': ['/Settings/SystemSetup/AcInput2', 0, 0, 1],
     }
@@ -867,94 +3147,224 @@ class hmControl:
     elif setting == '/StartLimit' or setting == '/StartLimitMax':
       self._checkStartLimit()
 
+    elif setting == '/BaseLoadPeriod':
+      self._loadPowerMin.setWindow(newvalue * 4)
+      self._loadPowerQuantile.setWindow(newvalue * 4)
+
+    elif setting == '/CommandSpacing':
+      self._mqttPool.setCommandSpacing(newvalue)
+
+    elif setting == '/IdleInterval':
+      self._scheduler.setIdlePeriod(newvalue)
+
+    elif setting == '/PerfFile':
+      self._setPerfFile(newvalue)
+
 
   def _updateVebusTotal(self):
-    inverterTotalPower = [0] * 3
-    inverterTotalCurrent = [0] * 3
-    inverterTotalPowerDC = 0
-    inverterTotalCurrentDC = 0
+    # Only when an inverter or the power meter reported new values
+    if self._fleet.changed == False and self._powerMeterChanged == False:
+      return
+    self._fleet.changed = False
+    self._powerMeterChanged = False
+    totals = self._fleet.totals
 
     if self._powerMeterService != None:
-      self._dbusservice['/Ac/Power'] =  self._dbusmonitor.get_value(self._powerMeterService,'/Ac/Power') or 0
-      for i in range(0,3):
-        inverterTotalPower[i] = self._dbusmonitor.get_value(self._powerMeterService,f'/Ac/L{i+1}/Power') or 0
-        inverterTotalCurrent[i] = self._dbusmonitor.get_value(self._powerMeterService,f'/Ac/L{i+1}/Current') or 0
+      acPower = self._powerMeterValues.get('/Ac/Power') or 0
+      inverterTotalPower = [self._powerMeterValues.get(f'/Ac/L{i+1}/Power') or 0 for i in range(0,3)]
+      inverterTotalCurrent = [self._powerMeterValues.get(f'/Ac/L{i+1}/Current') or 0 for i in range(0,3)]
     else:
-      for device in self._devices:
-        for i in range(0,3):
-          inverterTotalPower[i] += device.getDbusservice(f'/Ac/Inverter/L{i+1}/P')
-          inverterTotalCurrent[i] += device.getDbusservice(f'/Ac/Inverter/L{i+1}/I')
-      self._dbusservice['/Ac/Power'] = sum(inverterTotalPower)
+      inverterTotalPower = [totals[f'/Ac/Inverter/L{i+1}/P'] for i in range(0,3)]
+      inverterTotalCurrent = [totals[f'/Ac/Inverter/L{i+1}/I'] for i in range(0,3)]
+      acPower = sum(inverterTotalPower)
+    self._inverterPhasePower = inverterTotalPower
+    self._publisher.publish({'/Ac/Power': acPower})
 
-    for device in self._devices:
-      inverterTotalPowerDC += device.getDbusservice('/Dc/1/Power')
-      inverterTotalCurrentDC += device.getDbusservice('/Dc/1/Current')
+    inverterTotalPowerDC = totals['/Dc/1/Power']
+    inverterTotalCurrentDC = totals['/Dc/1/Current']
 
+    values = {}
     for i in range(0,3):
-      self._devices[0].setDbusservice(f'/Ac/ActiveIn/L{i+1}/P', 0 - inverterTotalPower[i])
-      self._devices[0].setDbusservice(f'/Ac/ActiveIn/L{i+1}/I', 0 - inverterTotalCurrent[i])
-    self._devices[0].setDbusservice('/Ac/ActiveIn/P', 0 - self._dbusservice['/Ac/Power'])
-    self._devices[0].setDbusservice('/Dc/0/Power', inverterTotalPowerDC)
-    self._devices[0].setDbusservice('/Dc/0/Current', inverterTotalCurrentDC)
+      values[f'/Ac/ActiveIn/L{i+1}/P'] = 0 - inverterTotalPower[i]
+      values[f'/Ac/ActiveIn/L{i+1}/I'] = 0 - inverterTotalCurrent[i]
+    values['/Ac/ActiveIn/P'] = 0 - acPower
+    values['/Dc/0/Power'] = inverterTotalPowerDC
+    values['/Dc/0/Current'] = inverterTotalCurrentDC
+    self._devices[0].publishDbusservice(values)
+
+    if self._recorder != None:
+      for index, device in enumerate(self._devices[:TRACE_MAX_INVERTERS]):
+        self._recorder.record(TRACE_INVERTER_POWER + index, device.getDbusservice('/Ac/Power'))
+
+
+  def _recomputeTotals(self):
+    # 60s interval
+    # Guard against drift of the running totals and missed power meter signals
+    self._fleet.reset({path: sum(device.getFleetValue(path) for device in self._devices) for path in FLEET_PATHS})
+    self._readPowerMeter()
+
+
+  def _readPowerMeter(self):
+    self._powerMeterValues = {}
+    if self._powerMeterService != None:
+      for path in _POWER_METER_PATHS:
+        self._powerMeterValues[path] = self._dbusmonitor.get_value(self._powerMeterService, path)
+    self._powerMeterChanged = True
+
+
+  def _updatePublisherStats(self):
+    itemsPublished = self._publisher.itemsPublished
+    itemsSuppressed = self._publisher.itemsSuppressed
+    signalsSaved = self._publisher.signalsSaved
+    for device in self._devices:
+      itemsPublished += device.getPublisher().itemsPublished
+      itemsSuppressed += device.getPublisher().itemsSuppressed
+      signalsSaved += device.getPublisher().signalsSaved
+
+    self._dbusservice['/Dbus/ItemsPublished'] = itemsPublished
+    self._dbusservice['/Dbus/ItemsSuppressed'] = itemsSuppressed
+    self._dbusservice['/Dbus/SignalsSaved'] = signalsSaved
+    self._dbusservice['/Dbus/Connections'] = dbusConnections.count
+    # ms spent opening bus connections
+    self._dbusservice['/Dbus/ConnectTime'] = int(dbusConnections.setupTime * 1000)
+
+
+  def _updateSchedulerStats(self):
+    # Maximum lateness in ms since the last update and the total of skipped runs
+    maxLateness = 0
+    skipped = 0
+    for task in self._scheduler.getTasks():
+      maxLateness = max(maxLateness, task.maxLateness)
+      task.maxLateness = 0
+      skipped += task.skipped
+
+    self._dbusservice['/Scheduler/MaxLateness'] = int(maxLateness * 1000)
+    self._dbusservice['/Scheduler/Skipped'] = skipped
+
+
+  def _updatePerfStats(self):
+    # Also keeps the samples of the histograms that are not published short
+    perf.fold()
+    values = {}
+    for name, (histogram, labels) in _PERF_HISTOGRAMS.items():
+      count, mean, p95, peak = perf.histogram(histogram, labels).interval()
+      values[f'/Perf/{name}/Mean'] = round(mean * 1000, 3)
+      values[f'/Perf/{name}/P95'] = round(p95 * 1000, 3)
+      values[f'/Perf/{name}/Max'] = round(peak * 1000, 3)
+
+    itemsPublished = self._publisher.itemsPublished
+    messages = 0
+    for device in self._devices:
+      itemsPublished += device.getPublisher().itemsPublished
+      messages += device.getMessageCount()
+    commands = 0
+    for connection in self._mqttPool.getConnections():
+      for queue in connection.getCommandQueues().values():
+        commands += queue.sent
+
+    now = self._scheduler.now()
+    if now > self._lastPerfTime:
+      values['/Perf/DbusWrites'] = round((itemsPublished - self._itemsPublished) / (now - self._lastPerfTime), 1)
+    self._itemsPublished = itemsPublished
+    self._lastPerfTime = now
+
+    values['/Perf/Messages'] = messages
+    values['/Perf/Commands'] = commands
+    values['/Perf/Exceptions'] = perf.total('exceptions_total')
+    self._publisher.publish(values)
+
+
+  def _perfValues(self):
+    # Counters of the connections and of this service for the performance export
+    values = []
+    for connection in self._mqttPool.getConnections():
+      broker = ('broker', connection.url)
+      values.append(('mqtt_connects_total', (broker,), connection.connects))
+      values.append(('mqtt_connected', (broker,), connection.connected))
+      for dtu, queue in connection.getCommandQueues().items():
+        labels = (broker, ('dtu', dtu))
+        values.append(('commands_sent_total', labels, queue.sent))
+        values.append(('commands_superseded_total', labels, queue.superseded))
+        values.append(('command_queue_depth', labels, queue.getDepth()))
+    for poller in self._httpPool.getPollers():
+      values.append(('http_requests_total', (('dtu', poller.url),), poller.requests))
+      values.append(('http_errors_total', (('dtu', poller.url),), poller.errors))
+    values.append(('dbus_items_published_total', (('inverter', 'hm'),), self._publisher.itemsPublished))
+    values.append(('scheduler_idle', (), 1 if self._scheduler.idle else 0))
+    values.append(('scheduler_skipped_total', (), sum(task.skipped for task in self._scheduler.getTasks())))
+    return values
+
+
+  def _setPerfFile(self, filename):
+    if self._perfFileTask is not None:
+      self._scheduler.remove(self._perfFileTask)
+      self._perfFileTask = None
+    if filename != '':
+      self._perfFileTask = self._scheduler.add('_writePerfFile', PERF_FILE_INTERVAL, self._writePerfFile, 5)
+
+
+  def _writePerfFile(self):
+    # 5min interval
+    try:
+      perf.writeTextfile(self.settings['/PerfFile'])
+    except Exception as e:
+      logging.warning("Writing %s failed: %s" % (self.settings['/PerfFile'], e))
 
 
   def _getSystemPower(self):
+    # While idle the control loop runs less often. A sample then stands for the time
+    # since the previous one, so the averages and the load minimum keep their length in s.
+    now = self._scheduler.now()
+    count = min(max(1, int(round((now - self._lastSystemSample) / CONTROL_INTERVAL))), self._loadPowerHistory.getWindow())
+    self._lastSystemSample = now
 
-    self._gridPower = self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Grid/L1/Power') + \
-                      self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Grid/L2/Power') + \
-                      self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Grid/L3/Power')
-    self._loadPower = self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L1/Power') + \
-                      self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L2/Power') + \
-                      self._dbusmonitor.get_value('com.victronenergy.system','/Ac/Consumption/L3/Power')
+    for i in range(0,3):
+      self._gridPhasePower[i] = self._system.gridPower[i]
+    self._gridPower = sum(self._gridPhasePower)
+    self._loadPower = sum(self._system.consumption)
 
-    self._gridPowerAvg.pop(0)
-    self._gridPowerAvg.append(self._gridPower)
+    for n in range(count):
+      for i in range(0,3):
+        self._gridPhasePowerAvg[i].append(self._gridPhasePower[i])
+      self._gridPowerAvg.append(self._gridPower)
+      self._loadPowerHistory.append(self._loadPower)
 
-    self._loadPowerHistory.pop(len(self._loadPowerHistory)-1)
-    self._loadPowerHistory.insert(0,self._loadPower)
 
+  def _samplePvPower(self):
     #5s interval
-    if self._controlLoopCounter % 10 == 0:
-      self._pvPowerAvg.pop(0)
-      self._pvPowerAvg.append(self._dbusmonitor.get_value('com.victronenergy.system','/Dc/Pv/Power') or 0)
+    self._pvPowerAvg.append(self._system.pvPower)
 
+
+  def _sampleLoadPower(self):
     # 15s interval
-    if self._controlLoopCounter % 30 == 0:
-      self._loadPowerMin.pop(len(self._loadPowerMin)-1)
-      self._loadPowerMin.insert(0,min(self._loadPowerHistory))
+    loadPowerMin = self._loadPowerHistory.min()
+    self._loadPowerMin.append(loadPowerMin)
+    self._loadPowerQuantile.append(loadPowerMin)
+    self._dbusservice['/BaseLoad'] = self._baseLoad()
+
 
+  def _updateAverages(self):
     # 60s interval
-    if self._controlLoopCounter % 120 == 0:
-      self._dbusservice['/PvAvgPower'] = int(sum(self._pvPowerAvg) / len(self._pvPowerAvg))
-      #self._dbusservice['/PvAvgPower'] = self._dbusservice['/Debug3']
+    self._dbusservice['/PvAvgPower'] = int(self._pvPowerAvg.mean())
+    #self._dbusservice['/PvAvgPower'] = self._dbusservice['/Debug3']
+    self._updatePublisherStats()
+    self._updateSchedulerStats()
+    self._updatePerfStats()
 
 
   def _calcLimit(self):
     
     if self._dbusservice['/State'] != 0:
-      
-      # 1min interval
-      if self._controlLoopCounter % 120 == 0:
-        self._checkStartLimit()
-
-      # Maximum power
-      if self.settings['/LimitMode'] == 0:
-        # 30s interval
-        if self._controlLoopCounter % 60 == 0:
-          newTarget = 0 
-          for device in self._devices:
-            newTarget += device.MaxPower
-          self._setLimit(newTarget)
 
       # Grid target limit mode
-      if self.settings['/LimitMode'] == 1 and self._powerLimitCounter >= self.settings['/GridTargetInterval'] * 2:
+      if self.settings['/LimitMode'] == 1 and self._scheduler.now() - self._lastLimitTime >= self.settings['/GridTargetInterval']:
         if self._gridPower < self.settings['/GridTargetPower'] - self.settings['/GridTargetDevMin'] \
         or self._gridPower > self.settings['/GridTargetPower'] + self.settings['/GridTargetDevMax']:
 
           if self._gridPower < self.settings['/GridTargetPower'] - 2 * self.settings['/GridTargetDevMin']:
             gridPowerTarget = self._gridPower
           else:
-            gridPowerTarget = sum(self._gridPowerAvg) / len(self._gridPowerAvg)
+            gridPowerTarget = self._gridPowerAvg.mean()
 
           #self._dbusservice['/Debug0']  =  self._gridPower
           #self._dbusservice['/Debug1']  =  gridPowerTarget
@@ -965,17 +3375,116 @@ class hmControl:
       # Base load limit mode
       if self.settings['/LimitMode'] == 2:
         #self._dbusservice['/Debug0']  =  self._gridPower
-        if self._gridPower < 0 and self._powerLimitCounter >= 8:
+        if self._gridPower < 0 and self._scheduler.now() - self._lastLimitTime >= 4:
           newTarget = self._actualLimit() + self._gridPower - 10
           logging.debug("set limit1: %s" % (newTarget))
           self._setLimit(newTarget)
 
-        # 15s interval
-        if self._controlLoopCounter % 30 == 0:
-          newTarget = min(self._loadPowerMin[0:int(self.settings['/BaseLoadPeriod'] * 4)]) - 10
-          if newTarget > self._actualLimit():
-            logging.debug("set limit2: %s" % (newTarget))
-            self._setLimit(newTarget)
+      # Grid target per phase limit mode
+      if self.settings['/LimitMode'] == 3:
+        values = {}
+        for phase in range(1, 4):
+          self._calcPhaseLimit(phase)
+          values[f'/Phase/L{phase}/Target'] = self._phaseTarget()
+          values[f'/Phase/L{phase}/Error'] = int(self._gridPhasePower[phase-1] - self._phaseTarget())
+        self._publisher.publish(values)
+
+
+  def _phaseTarget(self):
+    # The grid target power is split evenly over the phases, the tolerances apply per phase
+    return self.settings['/GridTargetPower'] / 3
+
+
+  def _calcPhaseLimit(self, phase):
+    gridPower = self._gridPhasePower[phase-1]
+    target = self._phaseTarget()
+
+    if self._scheduler.now() - self._lastPhaseLimitTime[phase-1] < self.settings['/GridTargetInterval']:
+      return
+
+    if gridPower < target - self.settings['/GridTargetDevMin'] or gridPower > target + self.settings['/GridTargetDevMax']:
+      if gridPower < target - 2 * self.settings['/GridTargetDevMin']:
+        gridPowerTarget = gridPower
+      else:
+        gridPowerTarget = self._gridPhasePowerAvg[phase-1].mean()
+
+      newTarget = self._inverterPhasePower[phase-1] + gridPowerTarget - target
+      logging.debug("set limit L%s: %s" % (phase, newTarget))
+      self._setLimit(newTarget, phase)
+
+
+  def _calcFastLimit(self, phase):
+    # Called on every grid power change: reduce the limit at once if the export exceeds the threshold,
+    # without waiting for the next control loop and the grid target interval
+    if self.settings['/FastLimitThreshold'] == 0 or self._dbusservice['/State'] == 0 or self.settings['/LimitMode'] not in (1, 2, 3):
+      return
+
+    if self.settings['/LimitMode'] == 3:
+      self._calcFastPhaseLimit(phase)
+      return
+
+    gridPower = sum(self._system.gridPower)
+
+    if gridPower >= -self.settings['/FastLimitThreshold']:
+      return
+
+    now = self._scheduler.now()
+    if now - self._lastFastLimitTime < self.settings['/FastLimitInterval']:
+      return
+    self._lastFastLimitTime = now
+
+    if self.settings['/LimitMode'] == 1:
+      newTarget = self._dbusservice['/Ac/Power'] + gridPower - self.settings['/GridTargetPower']
+    else:
+      newTarget = self._actualLimit() + gridPower - 10
+
+    logging.debug("set fast limit: %s" % (newTarget))
+    self._dbusservice['/FastLimitCount'] += 1
+    self._setLimit(newTarget)
+
+
+  def _calcFastPhaseLimit(self, phase):
+    # Per phase mode: only the inverters on the phase with the export are reduced
+    gridPower = self._system.gridPower[phase-1]
+
+    if gridPower >= -self.settings['/FastLimitThreshold']:
+      return
+
+    now = self._scheduler.now()
+    if now - self._lastFastPhaseLimitTime[phase-1] < self.settings['/FastLimitInterval']:
+      return
+    self._lastFastPhaseLimitTime[phase-1] = now
+
+    newTarget = self._inverterPhasePower[phase-1] + gridPower - self._phaseTarget()
+    logging.debug("set fast limit L%s: %s" % (phase, newTarget))
+    self._dbusservice['/FastLimitCount'] += 1
+    self._setLimit(newTarget, phase)
+
+
+  def _calcStartLimit(self):
+    # 1min interval
+    if self._dbusservice['/State'] != 0:
+      self._checkStartLimit()
+
+
+  def _calcMaxPowerLimit(self):
+    # 30s interval
+    # Maximum power
+    if self._dbusservice['/State'] != 0 and self.settings['/LimitMode'] == 0:
+      newTarget = 0 
+      for device in self._devices:
+        newTarget += device.MaxPower
+      self._setLimit(newTarget)
+
+
+  def _calcBaseLoadLimit(self):
+    # 15s interval
+    # Base load limit mode
+    if self._dbusservice['/State'] != 0 and self.settings['/LimitMode'] == 2:
+      newTarget = self._baseLoad() - 10
+      if newTarget > self._actualLimit():
+        logging.debug("set limit2: %s" % (newTarget))
+        self._setLimit(newTarget)
 
 
   def _checkState(self):
@@ -988,6 +3497,7 @@ class hmControl:
           device.setPowerLimit(1)
           device.Active = True
       self._dbusservice['/State'] = 1
+      self._scheduler.wake()
 
     elif self._batteryLifeIsSelfConsumption() == False and self._dbusservice['/State'] != 0:
       for device in self._devices:
@@ -1008,7 +3518,7 @@ class hmControl:
     
     # Check end of StartLimit mode
     if newLimit >= self.settings['/StartLimitMax'] or self.settings['/StartLimit'] == 0 \
-      or self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/BatteryLife/State') == 9:
+      or self._system.batteryLifeState == 9:
         # Activate all inverter
         for device in self._devices:
           if device.Active == False:
@@ -1047,65 +3557,81 @@ class hmControl:
     return True
 
 
-  def _setLimit(self, newLimit):
-    primaryMaxPower = self._devices[0].MaxPower
-    primaryMinPower = self._devices[0].MinPower
-    primaryPowerLimit = self._devices[0].PowerLimit
-    secondaryMinPower = 0
-    secondaryMaxPower = 0
-    secondaryPowerLimit = 0
-    limitSet = 0
+  def _setLimit(self, newLimit, phase=0):
+    # With phase 1..3 only the inverters feeding in on this phase are limited
+    start = time.perf_counter()
+    minPower, maxPower, limit, active, curves = self._fleetState()
 
     if self._dbusservice['/StartLimit'] > 0:
-      newLimit = min(newLimit, self._dbusservice['/StartLimit'])
+      startLimit = self._dbusservice['/StartLimit']
+      if phase:
+        # Share of the start limit in relation to the inverter power on this phase
+        activeMaxPower = sum(maxPower[i] for i in range(len(active)) if active[i])
+        phaseMaxPower = sum(maxPower[i] for i in range(len(active)) if active[i] and self._devices[i].settings['/Phase'] == phase)
+        startLimit = startLimit * phaseMaxPower / activeMaxPower if activeMaxPower > 0 else 0
+      newLimit = min(newLimit, startLimit)
+
+    if self._recorder != None:
+      self._recorder.record(TRACE_PHASE_LIMIT + phase - 1 if phase else TRACE_LIMIT, newLimit)
+
+    devices = self._devices
+    if phase:
+      # The active inverters of this phase are allocated as a fleet of their own, the first one is its primary
+      indices = [i for i in range(len(active)) if active[i] and devices[i].settings['/Phase'] == phase]
+      if not indices:
+        self._setLimitTime.observe(time.perf_counter() - start)
+        return
+      devices = [devices[i] for i in indices]
+      minPower, maxPower, limit, active, curves = ([values[i] for i in indices] for values in (minPower, maxPower, limit, active, curves))
 
-    for i in range(1, len(self._devices)):
-      if self._devices[i].Active == True:
-        secondaryMaxPower += self._devices[i].MaxPower
-        secondaryMinPower += self._devices[i].MinPower
-        secondaryPowerLimit += self._devices[i].PowerLimit
+    # The primary inverter counts even if it is not active, as allocatePrimary always sets its limit
+    counted = [i for i in range(len(active)) if active[i] or i == 0]
+    totalMaxPower = sum(maxPower[i] for i in counted)
+    totalPowerLimit = sum(limit[i] for i in counted)
 
-    if newLimit > primaryMaxPower + secondaryMaxPower and primaryMaxPower + secondaryMaxPower == primaryPowerLimit + secondaryPowerLimit \
-      or newLimit ==  primaryPowerLimit + secondaryPowerLimit:
+    if newLimit > totalMaxPower and totalMaxPower == totalPowerLimit or newLimit == totalPowerLimit:
+        self._setLimitTime.observe(time.perf_counter() - start)
         return 
 
-    self._powerLimitCounter = 0
+    now = self._scheduler.now()
+    if phase:
+      self._lastPhaseLimitTime[phase-1] = now
+    else:
+      self._lastLimitTime = now
+
+    # Every control action is traced from the latest grid sample it is based on
+    self._traceId += 1
+    trace = (self._traceId, self._gridSampleTime[phase-1] if phase else max(self._gridSampleTime), now)
+
+    allocator = LIMIT_ALLOCATORS.get(self.settings['/LimitAllocation'], allocatePrimary)
+    newLimits = allocator(newLimit, minPower, maxPower, limit, active, curves)
+    for device, value, current in zip(devices, newLimits, limit):
+      if value is not None and int(value) != current:
+        device.setPowerLimit(value, trace)
+    self._setLimitTime.observe(time.perf_counter() - start)
+
+
+  def _fleetState(self):
+    # Minimum and maximum power, limit, active state and efficiency curve of all inverters, read once per limit change
+    minPower = []
+    maxPower = []
+    limit = []
+    active = []
+    curves = []
+    for device in self._devices:
+      minPower.append(device.MinPower)
+      maxPower.append(device.MaxPower)
+      limit.append(device.PowerLimit)
+      active.append(device.Active == True)
+      curves.append(device.getEfficiencyCurve())
+    return minPower, maxPower, limit, active, curves
 
-    if newLimit >= primaryMaxPower + secondaryMaxPower:
-      for device in self._devices:
-        if device.Active == True:
-          limitSet += device.setPowerLimit(device.MaxPower)
-    
-    elif newLimit <= primaryMinPower + secondaryMinPower:
-      for device in self._devices:
-        if device.Active == True:
-          limitSet += device.setPowerLimit(device.MinPower)
 
-    else:
-      if primaryMaxPower >= newLimit - secondaryPowerLimit and primaryMinPower <= newLimit - secondaryPowerLimit:
-        limitSet += self._devices[0].setPowerLimit(newLimit - secondaryPowerLimit)
-        limitSet += secondaryPowerLimit
-      
-      elif newLimit <= (primaryMaxPower/2 + secondaryMinPower):
-        for i in range(1, len(self._devices)):
-          if self._devices[i].Active == True:
-            limitSet += self._devices[i].setPowerLimit(self._devices[i].MinPower)
-        limitSet += self._devices[0].setPowerLimit(newLimit - limitSet)
-      
-      elif newLimit >= (primaryMaxPower/2 + secondaryMaxPower):
-        for i in range(1, len(self._devices)):
-          if self._devices[i].Active == True:
-            limitSet += self._devices[i].setPowerLimit(self._devices[i].MaxPower)
-        limitSet += self._devices[0].setPowerLimit(newLimit - limitSet)
-      
-      else:
-        for i in range(1, len(self._devices)):
-          if self._devices[i].Active == True:
-            p = int((newLimit - primaryMaxPower/2) * self._devices[i].MaxPower / secondaryMaxPower)
-            limitSet += self._devices[i].setPowerLimit(p)
-        limitSet += self._devices[0].setPowerLimit(newLimit - limitSet)
-    
-    #self._dbusservice['/Debug2'] = limitSet
+  def _baseLoad(self):
+    # Lowest load, or a low quantile of the load to ignore short dips, during the base load period
+    if self.settings['/BaseLoadQuantile'] > 0:
+      return self._loadPowerQuantile.quantile(self.settings['/BaseLoadQuantile'] / 100)
+    return self._loadPowerMin.min()
 
 
   def _actualLimit(self):
@@ -1136,24 +3662,25 @@ class hmControl:
     # 6: SoC has been below SoC limit for more than 24 hours. Charging with battery with 5amps
     # 7: Multi/Quattro is in sustain
     # 8: Recharge, SOC dropped 5% or more below MinSOC.
-    if self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/BatteryLife/State') in (2, 3, 4):
+    state = self._system.batteryLifeState
+    soc = self._system.soc
+
+    if state in (2, 3, 4):
       return True
 
     # Keep batteries charged mode:
     # 9: 'Keep batteries charged' mode enabled
-    if self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/BatteryLife/State') == 9 \
-    and self._dbusmonitor.get_value('com.victronenergy.system','/Dc/Battery/Soc') > 95 and self._dbusservice['/State'] != 0:
+    if state == 9 and soc is not None and soc > 95 and self._dbusservice['/State'] != 0:
       return True
 
-    if self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/BatteryLife/State') == 9 \
-    and self._dbusmonitor.get_value('com.victronenergy.system','/Dc/Battery/Soc') == 100:
+    if state == 9 and soc == 100:
       return True
 
     # Optimized mode without BatteryLife:
     # 10: Self consumption, SoC at or above minimum SoC
     # 11: Self consumption, SoC is below minimum SoC
     # 12: Recharge, SOC dropped 5% or more below minimum SoC
-    if self._dbusmonitor.get_value('com.victronenergy.settings','/Settings/CGwacs/BatteryLife/State') == 10:
+    if state == 10:
       return True
 
     return False
@@ -1165,17 +3692,20 @@ class hmControl:
     deviceName = ''
 
     for service in self._dbusmonitor.get_service_list('com.victronenergy.acload'):
-      logging.debug("acload: %s %s %s" % (service, self._dbusmonitor.get_value(service,'/CustomName'), self._dbusmonitor.get_value(service,'/DeviceInstance')))
-      if self._dbusmonitor.get_value(service,'/CustomName') == None:
+      customName = self._dbusmonitor.get_value(service,'/CustomName')
+      deviceInstance = self._dbusmonitor.get_value(service,'/DeviceInstance')
+      logging.debug("acload: %s %s %s" % (service, customName, deviceInstance))
+      if customName == None:
         deviceName = self._dbusmonitor.get_value(service,'/ProductName')
       else:
-        deviceName = self._dbusmonitor.get_value(service,'/CustomName')
+        deviceName = customName
 
-      availableAcLoads.append(deviceName+':'+str(self._dbusmonitor.get_value(service,'/DeviceInstance')))
-      if self._dbusmonitor.get_value(service,'/DeviceInstance') == self.settings['/PowerMeterInstance'] and self._dbusmonitor.get_value(service,'/Connected') == 1:
+      availableAcLoads.append(deviceName+':'+str(deviceInstance))
+      if deviceInstance == self.settings['/PowerMeterInstance'] and self._dbusmonitor.get_value(service,'/Connected') == 1:
          powerMeterService = service
       
     self._powerMeterService = powerMeterService
+    self._readPowerMeter()
     self._dbusservice['/AvailableAcLoads'] = availableAcLoads
 
 
@@ -1184,8 +3714,16 @@ class hmControl:
   ###############################
 
 
+  def startProfile(self, duration=PROFILE_DEFAULT_DURATION):
+    # Also used as GLib signal handler for SIGUSR1
+    if self._profiler == None:
+      self._dbusservice['/Profile/Duration'] = duration
+      self._startProfile(duration)
+    return True
+
+
   def addDevice(self,deviceinstance):
-    newDevice = DbusHmInverterService(deviceinstance, self._dbusmonitor)
+    newDevice = DbusHmInverterService(deviceinstance, self._dbusmonitor, self._mqttPool, self._scheduler, self._fleet, self._httpPool)
     
     if self._dbusservice['/State'] != 0:
       newDevice.setPowerLimit(1)
@@ -1226,12 +3764,19 @@ def main():
 
       config = getConfig()
 
-      vebus = hmControl()
+      start = time.monotonic()
+      vebus = hmControl(Scheduler())
 
       for section in config.sections()[::-1]:
         if config.has_option(section, 'Deviceinstance') == True:
           vebus.addDevice(int(config[section]['Deviceinstance']))
 
+      logging.info("Startup took %.3fs, %d dbus connections opened in %.3fs" % (time.monotonic() - start, dbusConnections.count, dbusConnections.setupTime))
+
+      # kill -USR1 profiles the running service
+      if hasattr(gobject, 'unix_signal_add'):
+        gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR1, vebus.startProfile)
+
       #logging.getLogger().setLevel(logging.DEBUG)      
       mainloop.run()
 
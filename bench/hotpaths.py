@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Benchmarks of the control and telemetry hot paths with 1, 4, 16 and 64
+# simulated inverters. Results are written as JSON, one document per run, so
+# they can be compared between releases:
+#
+#   python bench/hotpaths.py [--inverters 1,4,16,64] [--output results.json]
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import standins
+
+
+def revision():
+  try:
+    return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                   cwd=sys.path[0]).decode().strip()
+  except Exception:
+    return None
+
+
+def measure(function, iterations, repeats=5):
+  # Time per call in microseconds for each repeat
+  results = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    for i in range(iterations):
+      function(i)
+    results.append((time.perf_counter() - start) * 1e6 / iterations)
+  return results
+
+
+def result(name, inverters, iterations, samples, unit='us/call'):
+  median = statistics.median(samples)
+  return {
+    'name': name,
+    'inverters': inverters,
+    'iterations': iterations,
+    'unit': unit,
+    'median': round(median, 3),
+    'min': round(min(samples), 3),
+    'max': round(max(samples), 3),
+    'per_second': round(1e6 / median, 1) if median > 0 else None,
+  }
+
+
+def benchMqttMessage(control, inverters, iterations):
+  connection = control._devices[0]._MQTT
+  msgs = []
+  for device in control._devices:
+    for key in device._inverterData[1]:
+      msgs.append(standins.FakeMQTTMessage(f'{device._inverterPath}/{key}', b'123.4'))
+
+  def run(i):
+    connection._on_MQTT_message(None, None, msgs[i % len(msgs)])
+  return result('mqtt_message', inverters, iterations, measure(run, iterations))
+
+
+def benchInverterUpdate(control, inverters, iterations):
+  devices = control._devices
+  frames = [device._inverterFrames[1] for device in devices]
+
+  def run(i):
+    # New power value on every inverter, then one tick of all inverter updates
+    for frame in frames:
+      frame.snapshot = (frame.snapshot[0] + 1, dict(frame.snapshot[1], **{'0/power': float(i % 600)}))
+    for device in devices:
+      device._inverterUpdate()
+  return result('inverter_update_tick', inverters, iterations, measure(run, iterations))
+
+
+def benchUpdateVebusTotal(control, inverters, iterations):
+  # Earlier releases aggregated on every call, so the totals are marked as changed to run the full update
+  def run(i):
+    control._fleet.changed = True
+    control._updateVebusTotal()
+  return result('update_vebus_total', inverters, iterations, measure(run, iterations))
+
+
+def benchUpdateVebusTotalChanged(control, inverters, iterations):
+  # One inverter reports a new AC power, then the totals are published
+  def run(i):
+    control._fleet.add('/Ac/Inverter/L1/P', 1 if i % 2 else -1)
+    control._updateVebusTotal()
+  return result('update_vebus_total_changed', inverters, iterations, measure(run, iterations))
+
+
+def benchSetLimit(control, inverters, iterations):
+  maxPower = sum(device.MaxPower for device in control._devices)
+
+  def run(i):
+    control._setLimit(maxPower * ((i % 20) + 1) / 21)
+  return result('set_limit', inverters, iterations, measure(run, iterations))
+
+
+def benchCalcLimit(control, inverters, iterations):
+  control.settings.change('/LimitMode', 1)
+  control.settings.change('/GridTargetInterval', 3)
+  clock = control._scheduler._clock
+
+  def run(i):
+    # Every call is past the grid target interval with a grid power outside the tolerance
+    clock.advance(5)
+    control._gridPower = -200 if i % 2 else 300
+    control._gridPowerAvg.append(control._gridPower)
+    control._calcLimit()
+  return result('calc_limit', inverters, iterations, measure(run, iterations))
+
+
+BENCHMARKS = [benchMqttMessage, benchInverterUpdate, benchUpdateVebusTotal, benchUpdateVebusTotalChanged, benchSetLimit,
+              benchCalcLimit]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the hot paths of HMpvinverter.py')
+  parser.add_argument('--inverters', default='1,4,16,64', help='comma separated inverter counts')
+  parser.add_argument('--iterations', type=int, default=2000, help='calls per repeat')
+  parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+  args = parser.parse_args()
+
+  standins.install()
+  results = []
+  for inverters in [int(n) for n in args.inverters.split(',')]:
+    for benchmark in BENCHMARKS:
+      control = standins.createControl(inverters)
+      results.append(benchmark(control, inverters, args.iterations))
+      print('%-26s %3d inverters %10.2f us/call' % (results[-1]['name'], inverters, results[-1]['median']), file=sys.stderr)
+
+  report = {
+    'revision': revision(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'platform': platform.platform(),
+    'results': results,
+  }
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+  main()
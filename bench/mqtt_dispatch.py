@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Messages per second through the shared MQTT connection into
+# DbusHmInverterService._on_MQTT_message, compared with the former linear scan
+# over all inverter keys.
+#
+#   python bench/mqtt_dispatch.py [messages]
+
+import sys
+import time
+
+import standins
+
+
+def linearScanDispatch(inverter, client, userdata, msg):
+  # Reference implementation of the dispatch before the topic index
+  try:
+    for k,v in inverter._inverterData[inverter.settings['/DTU']].items():
+      if msg.topic == f'{inverter._inverterPath}/{k}':
+        inverter._inverterData[inverter.settings['/DTU']][k] = float(msg.payload)
+        return
+  except Exception:
+    pass
+
+
+def messages(inverter, count):
+  keys = list(inverter._inverterData[inverter.settings['/DTU']])
+  return [standins.FakeMQTTMessage(f'{inverter._inverterPath}/{keys[i % len(keys)]}', b'%d.5' % (i % 600)) for i in range(count)]
+
+
+def measure(dispatch, inverter, msgs):
+  start = time.perf_counter()
+  for msg in msgs:
+    dispatch(None, None, msg)
+  return len(msgs) / (time.perf_counter() - start)
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  hm = standins.install()
+  monitor = standins.FakeDbusMonitor({})
+  scheduler = hm.Scheduler(standins.FakeClock())
+  pool = hm.MqttConnectionPool('bench', scheduler)
+
+  for dtu in (0, 1):
+    inverter = hm.DbusHmInverterService(51 + dtu, monitor, pool, scheduler)
+    inverter.settings.change('/DTU', dtu)
+    msgs = messages(inverter, count)
+
+    before = measure(lambda c, u, m: linearScanDispatch(inverter, c, u, m), inverter, msgs)
+    after = measure(inverter._MQTT._on_MQTT_message, inverter, msgs)
+    print(f"{'Ahoy' if dtu == 0 else 'OpenDTU':8} linear scan: {before:12.0f} msg/s   topic index: {after:12.0f} msg/s   x{after / before:.1f}")
+
+
+if __name__ == "__main__":
+  main()
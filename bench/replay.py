@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+# Replays a trace recorded with /Trace/Record on com.victronenergy.hm (or a
+# synthetic load profile) against hmControl, faster than real time, with a
+# simulated inverter response, and reports how well the grid target is held:
+#
+#   python bench/replay.py [trace.hmtr] [--modes 0,1,2,3] [--output results.json]
+#
+# The uncontrolled demand per phase is reconstructed as recorded grid power
+# plus recorded inverter power on that phase. The simulated grid power is that
+# demand minus the simulated inverter power. Energy is reported for the sum of
+# the phases (net metering) and per phase (phase-exact billing).
+
+import argparse
+import bisect
+import json
+import math
+import random
+import statistics
+import sys
+
+import standins
+
+
+class SimInverter:
+  # Inverter output follows the applied limit as a first order lag, limits are
+  # applied after the radio and DTU command delay
+  def __init__(self, device, delay, tau):
+    self.device = device
+    self.delay = delay
+    self.tau = tau
+    self.limit = device.PowerLimit
+    self.power = 0
+    self.pending = []
+
+
+  def command(self, now, limit):
+    self.pending.append((now + self.delay, limit))
+
+
+  def step(self, now, dt):
+    while self.pending and self.pending[0][0] <= now:
+      self.limit = self.pending.pop(0)[1]
+    self.power += (self.limit - self.power) * (1 - math.exp(-dt / self.tau))
+
+
+class Channel:
+  # Step function of a recorded channel
+  def __init__(self):
+    self.times = []
+    self.values = []
+
+
+  def add(self, t, value):
+    self.times.append(t)
+    self.values.append(value)
+
+
+  def at(self, t, default=0):
+    i = bisect.bisect_right(self.times, t) - 1
+    return self.values[i] if i >= 0 else default
+
+
+def loadTrace(filename, hm):
+  startTime, records = hm.TraceRecorder.read(filename)
+  channels = {}
+  for t, channel, value in records:
+    channels.setdefault(channel, Channel()).add(t, value)
+  duration = records[-1][0] if records else 0
+  return channels, duration
+
+
+def syntheticTrace(hm, duration, seed=1):
+  # Base load with a fridge cycle and random kettle, oven and washing machine steps on L1..L3
+  rng = random.Random(seed)
+  channels = {hm.TRACE_GRID + i: Channel() for i in range(3)}
+  channels.update({hm.TRACE_CONSUMPTION + i: Channel() for i in range(3)})
+  events = []
+  t = 0
+  while t < duration:
+    t += rng.expovariate(1 / 120)
+    events.append((t, rng.randrange(3), rng.choice([150, 400, 800, 1200]), rng.uniform(20, 300)))
+
+  for step in range(int(duration)):
+    for phase in range(3):
+      load = 120 + 40 * phase + (90 if (step // 600 + phase) % 2 == 0 else 0)
+      for start, eventPhase, power, length in events:
+        if eventPhase == phase and start <= step < start + length:
+          load += power
+      channels[hm.TRACE_GRID + phase].add(step, load)
+      channels[hm.TRACE_CONSUMPTION + phase].add(step, load)
+  return channels, duration
+
+
+def replay(hm, channels, duration, mode, args):
+  inverters = args.inverters or max([c - hm.TRACE_INVERTER_POWER + 1 for c in channels
+                                     if hm.TRACE_INVERTER_POWER <= c < hm.TRACE_INVERTER_POWER + hm.TRACE_MAX_INVERTERS], default=1)
+  clock = standins.FakeClock()
+  control = standins.createControl(inverters, clock)
+  control.settings.change('/LimitMode', mode)
+  control.settings.change('/FastLimitThreshold', args.fast_threshold)
+  monitor = control._dbusmonitor
+  client = control._devices[0]._MQTT._client
+
+  sims = {}
+  phases = []
+  for index, device in enumerate(control._devices):
+    if hm.TRACE_INVERTER_PHASE + index in channels:
+      device.settings.change('/Phase', int(channels[hm.TRACE_INVERTER_PHASE + index].values[0]))
+    if hm.TRACE_INVERTER_MAXPOWER + index in channels:
+      device.settings.change('/MaxPower', channels[hm.TRACE_INVERTER_MAXPOWER + index].values[0])
+    sims[device._inverterControlPath('limit_nonpersistent_absolute')] = SimInverter(device, args.command_delay, args.tau)
+    phases.append(device.settings['/Phase'] - 1)
+
+  setLimit = control._setLimit
+  calls = {'setLimit': 0}
+  def countingSetLimit(newLimit, phase=0):
+    calls['setLimit'] += 1
+    setLimit(newLimit, phase)
+  control._setLimit = countingSetLimit
+
+  target = control.settings['/GridTargetPower']
+  bandLow = target - control.settings['/GridTargetDevMin']
+  bandHigh = target + control.settings['/GridTargetDevMax']
+
+  dt = args.step
+  steps = int(duration / dt)
+  nextDtuUpdate = 0
+  exported = imported = 0
+  phaseExported = phaseImported = 0
+  commands = 0
+  excursion = None
+  settleTimes = []
+  overshoots = []
+  gridValues = {}
+  consumptionValues = {}
+  pvValue = None
+
+  for step in range(steps):
+    t = step * dt
+    clock.advance(dt)
+    now = clock()
+
+    # Limit commands published since the last step
+    for topic, payload in client.published:
+      if topic in sims:
+        sims[topic].command(now, float(payload))
+        commands += 1
+    client.published.clear()
+
+    inverterPower = [0, 0, 0]
+    for index, sim in enumerate(sims.values()):
+      sim.step(now, dt)
+      inverterPower[phases[index]] += sim.power
+
+    recordedInverterPower = [0, 0, 0]
+    for index in range(len(phases)):
+      channel = channels.get(hm.TRACE_INVERTER_POWER + index)
+      if channel is not None:
+        recordedInverterPower[phases[index]] += channel.at(t)
+
+    grid = 0
+    for phase in range(3):
+      value = round(channels[hm.TRACE_GRID + phase].at(t) + recordedInverterPower[phase] - inverterPower[phase], 1)
+      grid += value
+      if value < 0:
+        phaseExported -= value * dt / 3600
+      else:
+        phaseImported += value * dt / 3600
+      if gridValues.get(phase) != value:
+        gridValues[phase] = value
+        monitor.set_value('com.victronenergy.system', f'/Ac/Grid/L{phase + 1}/Power', value)
+      consumption = channels[hm.TRACE_CONSUMPTION + phase].at(t)
+      if consumptionValues.get(phase) != consumption:
+        consumptionValues[phase] = consumption
+        monitor.set_value('com.victronenergy.system', f'/Ac/Consumption/L{phase + 1}/Power', consumption)
+    if hm.TRACE_PV in channels and pvValue != channels[hm.TRACE_PV].at(t):
+      pvValue = channels[hm.TRACE_PV].at(t)
+      monitor.set_value('com.victronenergy.system', '/Dc/Pv/Power', pvValue)
+
+    # DTU publishes the inverter values
+    if t >= nextDtuUpdate:
+      nextDtuUpdate += args.dtu_interval
+      for sim in sims.values():
+        device = sim.device
+        for key, value in (('0/power', sim.power), ('0/powerdc', sim.power / 0.95), ('0/voltage', 230.0),
+                           ('status/limit_absolute', sim.limit)):
+          client.deliver(f'{device._inverterPath}/{key}', str(round(value, 1)).encode())
+
+    standins.GLib.run_idle()
+    control._scheduler.runPending()
+
+    # Metrics
+    if grid < 0:
+      exported -= grid * dt / 3600
+    else:
+      imported += grid * dt / 3600
+
+    outside = grid < bandLow or grid > bandHigh
+    if excursion is None and outside:
+      excursion = {'start': t, 'side': 1 if grid > bandHigh else -1, 'overshoot': 0}
+    elif excursion is not None:
+      if excursion['side'] > 0 and grid < bandLow:
+        excursion['overshoot'] = max(excursion['overshoot'], bandLow - grid)
+      elif excursion['side'] < 0 and grid > bandHigh:
+        excursion['overshoot'] = max(excursion['overshoot'], grid - bandHigh)
+      if not outside:
+        settleTimes.append(t - excursion['start'])
+        if excursion['overshoot'] > 0:
+          overshoots.append(excursion['overshoot'])
+        excursion = None
+
+  def summary(values):
+    if not values:
+      return {'count': 0}
+    values = sorted(values)
+    return {
+      'count': len(values),
+      'mean': round(statistics.mean(values), 2),
+      'p95': round(values[int(0.95 * (len(values) - 1))], 2),
+      'max': round(values[-1], 2),
+    }
+
+  return {
+    'limit_mode': mode,
+    'inverters': inverters,
+    'duration_s': round(duration, 1),
+    'grid_target_w': target,
+    'grid_band_w': [bandLow, bandHigh],
+    'time_to_target_s': summary(settleTimes),
+    'unsettled_at_end_s': round(duration - excursion['start'], 1) if excursion else 0,
+    'overshoot_w': summary(overshoots),
+    'exported_energy_wh': round(exported, 2),
+    'imported_energy_wh': round(imported, 2),
+    'phase_exported_energy_wh': round(phaseExported, 2),
+    'phase_imported_energy_wh': round(phaseImported, 2),
+    'set_limit_calls': calls['setLimit'],
+    'limit_commands': commands,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay a trace against hmControl')
+  parser.add_argument('trace', nargs='?', help='trace file recorded with /Trace/Record, synthetic load if omitted')
+  parser.add_argument('--modes', default='0,1,2,3', help='comma separated limit modes to compare')
+  parser.add_argument('--inverters', type=int, default=0, help='number of inverters, default from the trace')
+  parser.add_argument('--duration', type=float, default=3600, help='duration of the synthetic trace in seconds')
+  parser.add_argument('--step', type=float, default=0.1, help='simulation step in seconds')
+  parser.add_argument('--command-delay', type=float, default=2.0, help='delay until a limit is applied in seconds')
+  parser.add_argument('--tau', type=float, default=1.0, help='time constant of the inverter power in seconds')
+  parser.add_argument('--dtu-interval', type=float, default=5.0, help='interval of the DTU MQTT updates in seconds')
+  parser.add_argument('--fast-threshold', type=float, default=0, help='/FastLimitThreshold in W')
+  parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+  args = parser.parse_args()
+
+  hm = standins.install()
+  if args.trace:
+    channels, duration = loadTrace(args.trace, hm)
+    for phase in range(3):
+      channels.setdefault(hm.TRACE_GRID + phase, Channel())
+      channels.setdefault(hm.TRACE_CONSUMPTION + phase, Channel())
+  else:
+    channels, duration = syntheticTrace(hm, args.duration)
+    args.inverters = args.inverters or 4
+
+  results = [replay(hm, channels, duration, int(mode), args) for mode in args.modes.split(',')]
+  report = {'trace': args.trace or 'synthetic', 'results': results}
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+# Local stand-ins for the Venus OS runtime (GLib, dbus, velib_python, paho)
+# so HMpvinverter.py can be imported and driven without a GX device.
+
+import os
+import sys
+import types
+
+
+class FakeClock:
+  def __init__(self, start=1000.0):
+    self.t = start
+
+  def __call__(self):
+    return self.t
+
+  def advance(self, seconds):
+    self.t += seconds
+
+
+################################################################################
+#   GLib                                                                       #
+################################################################################
+
+class FakeGLib(types.ModuleType):
+  def __init__(self):
+    types.ModuleType.__init__(self, 'GLib')
+    self._sources = {}
+    self._nextId = 1
+
+  def timeout_add(self, interval, callback, *args):
+    sourceId = self._nextId
+    self._nextId += 1
+    self._sources[sourceId] = ['timeout', interval, callback, args]
+    return sourceId
+
+  def timeout_add_seconds(self, interval, callback, *args):
+    return self.timeout_add(interval * 1000, callback, *args)
+
+  def idle_add(self, callback, *args):
+    sourceId = self._nextId
+    self._nextId += 1
+    self._sources[sourceId] = ['idle', 0, callback, args]
+    return sourceId
+
+  def source_remove(self, sourceId):
+    return self._sources.pop(sourceId, None) is not None
+
+  def run_idle(self):
+    # Run all pending idle callbacks once, like one GLib main loop iteration
+    for sourceId, source in list(self._sources.items()):
+      if source[0] == 'idle' and sourceId in self._sources:
+        if not source[2](*source[3]):
+          self._sources.pop(sourceId, None)
+
+  def run_timeouts(self):
+    # Fire every pending timeout once, regardless of its interval
+    for sourceId, source in list(self._sources.items()):
+      if source[0] == 'timeout' and sourceId in self._sources:
+        if not source[2](*source[3]):
+          self._sources.pop(sourceId, None)
+
+  def clear(self):
+    self._sources.clear()
+
+  class MainLoop:
+    def run(self):
+      pass
+
+    def quit(self):
+      pass
+
+
+################################################################################
+#   dbus                                                                       #
+################################################################################
+
+class FakeBusConnection(object):
+  TYPE_SYSTEM = 1
+  TYPE_SESSION = 0
+  created = 0
+
+  def __new__(cls, *args, **kwargs):
+    FakeBusConnection.created += 1
+    return object.__new__(cls)
+
+
+################################################################################
+#   velib_python                                                               #
+################################################################################
+
+class FakeServiceContext:
+  def __init__(self, parent):
+    self.parent = parent
+    self.changes = {}
+
+  def __getitem__(self, path):
+    return self.parent[path]
+
+  def __setitem__(self, path, value):
+    if self.parent._values[path] != value:
+      self.parent._values[path] = value
+      self.parent.writes += 1
+      self.changes[path] = value
+
+  def flush(self):
+    if self.changes:
+      self.parent.signals += 1
+      self.changes = {}
+
+
+class FakeVeDbusService:
+  def __init__(self, servicename, bus=None, register=True):
+    self.name = servicename
+    self._values = {}
+    self._callbacks = {}
+    self._contexts = []
+    self.writes = 0
+    self.signals = 0
+
+  def add_path(self, path, value, description="", writeable=False,
+               onchangecallback=None, gettextcallback=None, valuetype=None, itemtype=None):
+    self._values[path] = value
+    self._callbacks[path] = onchangecallback
+
+  def register(self):
+    pass
+
+  def __contains__(self, path):
+    return path in self._values
+
+  def __getitem__(self, path):
+    return self._values[path]
+
+  def __setitem__(self, path, value):
+    # Mirrors VeDbusItemExport.local_set_value: unchanged values are not sent
+    if self._values[path] != value:
+      self._values[path] = value
+      self.writes += 1
+      self.signals += 1
+
+  def __enter__(self):
+    context = FakeServiceContext(self)
+    self._contexts.append(context)
+    return context
+
+  def __exit__(self, *exc):
+    if self._contexts:
+      self._contexts.pop().flush()
+
+  def remoteWrite(self, path, value):
+    # Simulate a write from another process (GUI, systemcalc)
+    callback = self._callbacks.get(path)
+    if callback is None or callback(path, value):
+      self._values[path] = value
+
+
+class FakeSettingsDevice:
+  def __init__(self, bus, supportedSettings, eventCallback, name=None, timeout=0):
+    self._values = {k: v[1] for k, v in supportedSettings.items()}
+    self._eventCallback = eventCallback
+
+  def __getitem__(self, setting):
+    return self._values[setting]
+
+  def __setitem__(self, setting, value):
+    self._values[setting] = value
+
+  def change(self, setting, value):
+    # Simulate a change coming in from com.victronenergy.settings
+    old = self._values[setting]
+    self._values[setting] = value
+    self._eventCallback(setting, old, value)
+
+
+class FakeDbusMonitor:
+  def __init__(self, dbusTree, valueChangedCallback=None, deviceAddedCallback=None,
+               deviceRemovedCallback=None, **kwargs):
+    self.dbusTree = dbusTree
+    self.valueChangedCallback = valueChangedCallback
+    self.values = {
+      ('com.victronenergy.system', '/Serial'): 'c0619ab00000',
+      ('com.victronenergy.settings', '/Settings/CGwacs/BatteryLife/State'): 10,
+      ('com.victronenergy.system', '/Dc/Battery/Soc'): 80,
+      ('com.victronenergy.system', '/Dc/Pv/Power'): 0,
+      ('com.victronenergy.system', '/VebusService'): 'com.victronenergy.vebus.DTU_id51',
+    }
+    for i in range(1, 4):
+      self.values[('com.victronenergy.system', f'/Ac/Grid/L{i}/Power')] = 0
+      self.values[('com.victronenergy.system', f'/Ac/Consumption/L{i}/Power')] = 0
+    self.reads = 0
+
+  def get_value(self, serviceName, objectPath, default_value=None):
+    self.reads += 1
+    value = self.values.get((serviceName, objectPath))
+    return default_value if value is None else value
+
+  def get_service_list(self, classfilter=None):
+    return {}
+
+  def set_value(self, serviceName, objectPath, value, deviceInstance=0):
+    # Simulate a PropertiesChanged signal from a monitored service
+    self.values[(serviceName, objectPath)] = value
+    if self.valueChangedCallback is not None:
+      self.valueChangedCallback(serviceName, objectPath, {}, {'Value': value, 'Text': str(value)}, deviceInstance)
+
+
+################################################################################
+#   paho                                                                       #
+################################################################################
+
+class FakeMQTTMessage:
+  __slots__ = ('topic', 'payload')
+
+  def __init__(self, topic, payload):
+    self.topic = topic
+    self.payload = payload
+
+
+class FakeMqttClient:
+  def __init__(self, client_id='', *args, **kwargs):
+    self.client_id = client_id
+    self.published = []
+    self.subscribed = []
+    self.connects = 0
+    self.loops = 0
+    self.on_connect = None
+    self.on_disconnect = None
+    self.on_message = None
+
+  def connect(self, host, *args, **kwargs):
+    self.host = host
+    self.connects += 1
+    return 0
+
+  def connect_async(self, host, *args, **kwargs):
+    self.host = host
+    self.connects += 1
+
+  def reconnect(self):
+    self.connects += 1
+    return 0
+
+  def disconnect(self):
+    return 0
+
+  def reconnect_delay_set(self, min_delay=1, max_delay=120):
+    self.reconnectDelay = (min_delay, max_delay)
+
+  def loop_start(self):
+    self.loops += 1
+
+  def loop_stop(self, force=False):
+    self.loops -= 1
+
+  def subscribe(self, topic, qos=0):
+    self.subscribed.append(topic)
+    return (0, len(self.subscribed))
+
+  def unsubscribe(self, topic):
+    return (0, 0)
+
+  def publish(self, topic, payload=None, qos=0, retain=False):
+    self.published.append((topic, payload))
+
+  def deliver(self, topic, payload):
+    # Simulate a message arriving on the paho network thread
+    self.on_message(self, None, FakeMQTTMessage(topic, payload))
+
+
+################################################################################
+#   Installation                                                               #
+################################################################################
+
+GLib = FakeGLib()
+
+
+def install():
+  # Register the stand-ins in sys.modules and import HMpvinverter against them
+  if 'HMpvinverter' in sys.modules:
+    return sys.modules['HMpvinverter']
+
+  gi = types.ModuleType('gi')
+  repository = types.ModuleType('gi.repository')
+  repository.GLib = GLib
+  gi.repository = repository
+
+  dbus = types.ModuleType('dbus')
+  bus = types.ModuleType('dbus.bus')
+  bus.BusConnection = FakeBusConnection
+  dbus.bus = bus
+  mainloop = types.ModuleType('dbus.mainloop')
+  glib = types.ModuleType('dbus.mainloop.glib')
+  glib.DBusGMainLoop = lambda set_as_default=False: None
+  dbus.mainloop = mainloop
+  mainloop.glib = glib
+
+  paho = types.ModuleType('paho')
+  pahoMqtt = types.ModuleType('paho.mqtt')
+  pahoClient = types.ModuleType('paho.mqtt.client')
+  pahoClient.Client = FakeMqttClient
+  pahoClient.MQTTMessage = FakeMQTTMessage
+  paho.mqtt = pahoMqtt
+  pahoMqtt.client = pahoClient
+
+  requests = types.ModuleType('requests')
+  requests.Session = object
+
+  vedbus = types.ModuleType('vedbus')
+  vedbus.VeDbusService = FakeVeDbusService
+  settingsdevice = types.ModuleType('settingsdevice')
+  settingsdevice.SettingsDevice = FakeSettingsDevice
+  dbusmonitor = types.ModuleType('dbusmonitor')
+  dbusmonitor.DbusMonitor = FakeDbusMonitor
+
+  for name, module in {
+      'gi': gi, 'gi.repository': repository,
+      'dbus': dbus, 'dbus.bus': bus, 'dbus.mainloop': mainloop, 'dbus.mainloop.glib': glib,
+      'paho': paho, 'paho.mqtt': pahoMqtt, 'paho.mqtt.client': pahoClient,
+      'requests': requests,
+      'vedbus': vedbus, 'settingsdevice': settingsdevice, 'dbusmonitor': dbusmonitor}.items():
+    sys.modules.setdefault(name, module)
+
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+  import HMpvinverter
+  return HMpvinverter
+
+
+def createControl(inverters, clock=None, dtu=1):
+  # hmControl with `inverters` enabled and running inverters, each on its own MQTT path
+  hm = install()
+  GLib.clear()
+  clock = clock or FakeClock()
+  control = hm.hmControl(hm.Scheduler(clock))
+  for i in range(inverters):
+    control.addDevice(51 + i)
+
+  for i, device in enumerate(control._devices):
+    device.settings.change('/DTU', dtu)
+    device.settings.change('/InverterPath', f'solar/11418000{i:04d}')
+    device.settings.change('/Phase', i % 3 + 1)
+    device.setDbusservice('/Enabled', 1)
+    device.setDbusservice('/RunState', 2)
+    device.Active = True
+  control._dbusservice['/State'] = 1
+  return control
@@ -123,6 +123,28 @@ MbPage {
 			]
 		}
 
+		MbItemOptions {
+			id: transport
+			description: qsTr("Transport")
+			bind: Utils.path(settingsPrefix, "/Transport")
+			readonly: false
+			editable: true
+			possibleValues:[
+				MbOption{description: qsTr("MQTT"); value: 0 },
+				MbOption{description: qsTr("HTTP"); value: 1 }
+			]
+		}
+
+		MbEditBoxIp {
+			show: transport.value === 1
+			description: qsTr("DTU URL")
+			item: VBusItem {
+				id: dtuUrl
+				isSetting: true
+				bind: Utils.path(settingsPrefix, "/DtuUrl")
+			}
+		}
+
 		MbSpinBox {
 			id: inverterID
 			show: dtu.value === 0
@@ -136,6 +158,12 @@ MbPage {
 			}
 		}
 
+		MbSwitch {
+			id: eventUpdate
+			bind: Utils.path(settingsPrefix, "/EventUpdate")
+			name: qsTr("Event Driven Update")
+		}
+
 		MbSwitch {
 			id: startLimiter
 			bind: Utils.path(controlSettings, "/StartLimit")
@@ -181,13 +209,29 @@ MbPage {
 			possibleValues:[
 				MbOption{description: qsTr("Maximum Power"); value: 0 },
 				MbOption{description: qsTr("Grid Target"); value: 1 },
-				MbOption{description: qsTr("Base Load"); value: 2 }
+				MbOption{description: qsTr("Base Load"); value: 2 },
+				MbOption{description: qsTr("Grid Target per Phase"); value: 3 }
+			]
+		}
+
+		MbItemOptions {
+			id: limitAllocation
+			description: qsTr("Limit Allocation")
+			bind: Utils.path(controlSettings, "/LimitAllocation")
+			readonly: false
+			editable: true
+			show: isMaster.value === 1
+			possibleValues:[
+				MbOption{description: qsTr("Master First"); value: 0 },
+				MbOption{description: qsTr("Fewest Changes"); value: 1 },
+				MbOption{description: qsTr("Balanced"); value: 2 },
+				MbOption{description: qsTr("Efficiency"); value: 3 }
 			]
 		}
 
 		MbSpinBox {
 			id: gridTargetInterval
-			show: limitMode.value === 1 && isMaster.value === 1
+			show: (limitMode.value === 1 || limitMode.value === 3) && isMaster.value === 1
 			description: qsTr("Grid Target Interval")
 			item {
 				bind: Utils.path(controlSettings, "/GridTargetInterval")
@@ -201,7 +245,7 @@ MbPage {
 
 		MbSpinBox {
 			id: gridTargetPower
-			show: limitMode.value === 1 && isMaster.value === 1
+			show: (limitMode.value === 1 || limitMode.value === 3) && isMaster.value === 1
 			description: qsTr("Grid Target Power")
 			item {
 				bind: Utils.path(controlSettings, "/GridTargetPower")
@@ -215,7 +259,7 @@ MbPage {
 
 		MbSpinBox {
 			id: gridTargetDevMin
-			show: limitMode.value === 1 && isMaster.value === 1
+			show: (limitMode.value === 1 || limitMode.value === 3) && isMaster.value === 1
 			description: qsTr("Grid Target Tolerance Minimum")
 			item {
 				bind: Utils.path(controlSettings, "/GridTargetDevMin")
@@ -229,7 +273,7 @@ MbPage {
 
 		MbSpinBox {
 			id: gridTargetDevMax
-			show: limitMode.value === 1 && isMaster.value === 1
+			show: (limitMode.value === 1 || limitMode.value === 3) && isMaster.value === 1
 			description: qsTr("Grid Target Tolerance Maximum")
 			item {
 				bind: Utils.path(controlSettings, "/GridTargetDevMax")
@@ -250,11 +294,81 @@ MbPage {
 				unit: "min"
 				decimals: 1
 				step: 0.5
+				max: 240
+				min: 0.5
+			}
+		}
+
+		MbSpinBox {
+			id: baseLoadQuantile
+			show: limitMode.value === 2 && isMaster.value === 1
+			description: qsTr("Base Load Quantile")
+			item {
+				bind: Utils.path(controlSettings, "/BaseLoadQuantile")
+				unit: "%"
+				decimals: 0
+				step: 1
+				max: 25
+				min: 0
+			}
+		}
+
+		MbSpinBox {
+			id: fastLimitThreshold
+			show: limitMode.value !== 0 && isMaster.value === 1
+			description: qsTr("Fast Export Threshold")
+			item {
+				bind: Utils.path(controlSettings, "/FastLimitThreshold")
+				unit: "W"
+				decimals: 0
+				step: 10
+				max: 1000
+				min: 0
+			}
+		}
+
+		MbSpinBox {
+			id: fastLimitInterval
+			show: limitMode.value !== 0 && fastLimitThreshold.item.value > 0 && isMaster.value === 1
+			description: qsTr("Fast Export Interval")
+			item {
+				bind: Utils.path(controlSettings, "/FastLimitInterval")
+				unit: "s"
+				decimals: 1
+				step: 0.5
 				max: 10
 				min: 0.5
 			}
 		}
 
+		MbSpinBox {
+			id: commandSpacing
+			show: isMaster.value === 1
+			description: qsTr("DTU Command Spacing")
+			item {
+				bind: Utils.path(controlSettings, "/CommandSpacing")
+				unit: "s"
+				decimals: 1
+				step: 0.1
+				max: 5
+				min: 0
+			}
+		}
+
+		MbSpinBox {
+			id: idleInterval
+			show: isMaster.value === 1
+			description: qsTr("Idle Interval")
+			item {
+				bind: Utils.path(controlSettings, "/IdleInterval")
+				unit: "s"
+				decimals: 1
+				step: 0.5
+				max: 60
+				min: 0.5
+			}
+		}
+
 		MbItemOptions {
 			id: acLoad
 			show: isMaster.value === 1
@@ -0,0 +1,10 @@
+# The tests run the service code against the stand-ins of bench/standins.py
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bench'))
+
+import standins
+
+standins.install()
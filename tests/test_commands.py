@@ -0,0 +1,26 @@
+import standins
+
+
+def test_command_timer_only_while_pending():
+  clock = standins.FakeClock()
+  control = standins.createControl(3, clock)
+  scheduler = control._scheduler
+  device = control._devices[0]
+  client = device._MQTT._client
+  queue = device._commandQueue()
+  sendTasks = lambda: [task for task in scheduler.getTasks() if task.name == '_sendCommand']
+  assert sendTasks() == []
+
+  published = len(client.published)
+  for device in control._devices:
+    device._inverterSetPower(device.PowerLimit + 100)
+  # The first command is sent at once, the others wait for the spacing
+  assert len(client.published) == published + 1
+  assert len(sendTasks()) == 1
+
+  for i in range(4):
+    clock.advance(0.5)
+    scheduler.runPending()
+  assert len(client.published) == published + 3
+  assert queue.getDepth() == 0
+  assert sendTasks() == []
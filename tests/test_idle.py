@@ -0,0 +1,42 @@
+import standins
+
+
+def runFor(control, clock, seconds):
+  # Run the scheduler from deadline to deadline like the GLib timer, returns the number of wakeups
+  scheduler = control._scheduler
+  end = clock.t + seconds
+  wakeups = set()
+  while True:
+    deadline = min(task.deadline for task in scheduler.getTasks())
+    if deadline > end:
+      clock.t = end
+      return len(wakeups)
+    clock.t = max(clock.t, deadline)
+    scheduler.runPending()
+    wakeups.add(clock.t)
+
+
+def idleControl():
+  clock = standins.FakeClock()
+  control = standins.createControl(4, clock)
+  for device in control._devices:
+    device.Active = False
+  runFor(control, clock, 60)
+  return control, clock
+
+
+def test_idle_wakeups():
+  control, clock = idleControl()
+  assert control._scheduler.idle
+  # The 0.5 s loops alone would wake up 120 times a minute
+  assert runFor(control, clock, 60) <= 30
+
+
+def test_idle_windows_keep_their_length():
+  control, clock = idleControl()
+  monitor = control._dbusmonitor
+  for i in range(1, 4):
+    monitor.set_value('com.victronenergy.system', f'/Ac/Grid/L{i}/Power', 100)
+  runFor(control, clock, control.settings['/IdleInterval'])
+  # One idle sample covers the 3 s of the grid power average
+  assert control._gridPowerAvg.mean() == 300
@@ -0,0 +1,75 @@
+import standins
+
+hm = standins.install()
+
+
+def phaseControl(phases, allocation=0):
+  control = standins.createControl(len(phases))
+  control.settings.change('/LimitAllocation', allocation)
+  for device, phase in zip(control._devices, phases):
+    device.settings.change('/Phase', phase)
+  return control
+
+
+def test_phase_limit_primary_on_other_phase():
+  # The master feeds in on L1, a limit for L2 is allocated over the L2 inverters only
+  control = phaseControl([1, 2, 2])
+  before = control._devices[0].PowerLimit
+
+  control._setLimit(900, 2)
+
+  assert control._devices[0].PowerLimit == before
+  assert control._devices[1].PowerLimit + control._devices[2].PowerLimit == 900
+
+
+def test_limit_resends_capped_if_report_never_matches():
+  # Ahoy reports the limit in % of the rated power of the inverter (600 W), /MaxPower is set to 800 W
+  clock = standins.FakeClock()
+  control = standins.createControl(1, clock, dtu=0)
+  device = control._devices[0]
+  device.settings.change('/MaxPower', 800)
+  device.setPowerLimit(400)
+
+  for i in range(20):
+    clock.advance(hm.LIMIT_ACK_TIMEOUT)
+    device._limitReported('ch0/active_PowerLimit', 400 / 600 * 100)
+    device._checkLimitTimeout()
+
+  assert device.getDbusservice('/Dtu/LimitResends') == hm.LIMIT_RESEND_MAX
+  assert device._limitCommand is None
+
+
+def test_limit_sent_at_once_is_traced():
+  clock = standins.FakeClock()
+  control = standins.createControl(1, clock)
+  device = control._devices[0]
+
+  for limit in (200, 400, 300):
+    clock.advance(10)
+    # The spacing has elapsed, the command queue publishes the limit at once
+    device.setPowerLimit(limit, (1, clock.t - 1, clock.t))
+    assert device._limitTrace is not None
+    assert device._limitTrace.publish == clock.t
+    device._checkTraceResponse(limit)
+    assert device._limitTrace is None
+
+  assert device._traceResults['complete'] == 3
+
+
+def test_no_limit_resends_while_inverter_off():
+  clock = standins.FakeClock()
+  control = standins.createControl(1, clock)
+  device = control._devices[0]
+  client = device._MQTT._client
+  device.setPowerLimit(400)
+  # The inverter stops answering at dusk
+  device.setDbusservice('/RunState', 0)
+  device._limitApplied = 300
+  published = len(client.published)
+
+  for i in range(20):
+    clock.advance(hm.LIMIT_ACK_TIMEOUT)
+    device._checkLimitTimeout()
+
+  assert len(client.published) == published
+  assert device.getDbusservice('/Dtu/LimitResends') == 0
@@ -0,0 +1,19 @@
+import standins
+
+hm = standins.install()
+
+
+def test_histogram_samples_stay_bounded():
+  clock = standins.FakeClock()
+  control = standins.createControl(4, clock)
+  scheduler = control._scheduler
+  hm.perf.fold()
+  end = clock.t + 3600
+  while True:
+    deadline = min(task.deadline for task in scheduler.getTasks())
+    if deadline > end:
+      break
+    clock.t = max(clock.t, deadline)
+    scheduler.runPending()
+    # At most one minute of samples, the 0.5 s loops of 4 inverters share one histogram
+    assert max(len(histogram.samples) for histogram in hm.perf.histograms.values()) <= 4 * 121
@@ -0,0 +1,27 @@
+import standins
+
+hm = standins.install()
+
+
+def publisher():
+  service = standins.FakeVeDbusService('com.victronenergy.test')
+  for path in ('/Ac/Power', '/Ac/L1/Voltage', '/Ac/L1/Power'):
+    service.add_path(path, 0)
+  return hm.DbusPublisher(service)
+
+
+def test_signals_saved_by_batching_only():
+  p = publisher()
+  p.publish({'/Ac/Power': 100, '/Ac/L1/Voltage': 230, '/Ac/L1/Power': 100})
+  assert p.signalsSaved == 2
+
+  # Unchanged values were never signalled, they save nothing
+  p.publish({'/Ac/Power': 100, '/Ac/L1/Voltage': 230, '/Ac/L1/Power': 100})
+  assert p.signalsSaved == 2
+  assert p.itemsSuppressed == 0
+
+  # A voltage change within the deadband is suppressed
+  p.publish({'/Ac/Power': 150, '/Ac/L1/Voltage': 230.02, '/Ac/L1/Power': 100})
+  assert p.signalsSaved == 2
+  assert p.itemsSuppressed == 1
+  assert p.itemsPublished == 4
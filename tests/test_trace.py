@@ -0,0 +1,44 @@
+import standins
+
+hm = standins.install()
+
+
+def test_trace_channels_of_many_inverters(tmp_path):
+  filename = str(tmp_path / 'trace.hmtr')
+  clock = standins.FakeClock()
+  recorder = hm.TraceRecorder(filename, clock)
+  for index in range(64):
+    recorder.record(hm.TRACE_INVERTER_POWER + index, 100 + index)
+    recorder.record(hm.TRACE_INVERTER_PHASE + index, index % 3 + 1)
+    recorder.record(hm.TRACE_INVERTER_MAXPOWER + index, 600)
+  recorder.close()
+
+  startTime, records = hm.TraceRecorder.read(filename)
+  channels = {channel: value for t, channel, value in records}
+  assert len(channels) == 3 * 64
+  assert channels[hm.TRACE_INVERTER_POWER + 63] == 163
+  assert channels[hm.TRACE_INVERTER_PHASE + 63] == 1
+
+
+def test_failed_trace_start_is_cleaned_up(monkeypatch):
+  control = standins.createControl(2)
+  closed = []
+
+  class FailingRecorder(hm.TraceRecorder):
+    def __init__(self, filename, clock):
+      self.records = 0
+
+    def record(self, channel, value):
+      raise OSError(28, 'No space left on device')
+
+    def close(self):
+      closed.append(self)
+
+  monkeypatch.setattr(hm, 'TraceRecorder', FailingRecorder)
+  tasks = len(control._scheduler.getTasks())
+  control._dbusservice.remoteWrite('/Trace/Record', 1)
+
+  assert control._dbusservice['/Trace/Record'] == 0
+  assert control._recorder is None
+  assert len(closed) == 1
+  assert len(control._scheduler.getTasks()) == tasks